@@ -1,5 +1,6 @@
 import asyncio
 import inspect
+import json
 import logging
 import math
 import os
@@ -29,11 +30,14 @@ from discord.enums import ChannelType
 from discord.ext.commands.bot import _get_variable
 
 from . import downloader, exceptions
+from .cache import AudioCacheManager, ContentStore, LoudnessAnalyzer, MediaProbe, OpusCache
 from .config import Config, ConfigDefaults
 from .constants import VERSION as BOTVERSION
-from .constants import AUDIO_CACHE_PATH, DISCORD_MSG_CHAR_LIMIT
+from .constants import AUDIO_CACHE_PATH, AUDIO_CACHE_STATS_PATH, INFO_CACHE_PATH, SEARCH_CACHE_PATH, LOUDNESS_PATH
+from .constants import PROBE_CACHE_PATH, DISCORD_MSG_CHAR_LIMIT
 from .constructs import Response, SkipState, VoiceStateUpdate
 from .entry import StreamPlaylistEntry
+from .journal import QueueJournal, write_atomic
 from .opus_loader import load_opus_lib
 from .player import MusicPlayer
 from .playlist import Playlist
@@ -55,6 +59,7 @@ class MusicBot(discord.Client):
             config_file = ConfigDefaults.options_file
 
         self.players = {}
+        self.queue_saves = set()
         self.exit_signal = None
         self.init_ok = False
         self.cached_app_info = None
@@ -67,7 +72,37 @@ class MusicBot(discord.Client):
         self.autoplaylist_session = self.autoplaylist[:]
 
         self.aiolocks = defaultdict(asyncio.Lock)
-        self.downloader = downloader.Downloader(download_folder='audio_cache')
+        self.downloader = downloader.Downloader(
+            download_folder='audio_cache',
+            info_cache_folder=INFO_CACHE_PATH,
+            search_cache_folder=SEARCH_CACHE_PATH,
+            metadata_workers=self.config.metadata_workers,
+            download_workers=self.config.download_workers,
+            extractor_processes=self.config.extractor_processes,
+            metadata_timeout=self.config.metadata_timeout,
+            download_timeout=self.config.download_timeout
+        )
+
+        self.opus_cache = None
+        if self.config.opus_cache:
+            self.opus_cache = OpusCache(os.path.join(AUDIO_CACHE_PATH, '.opus'))
+
+        self.probes = MediaProbe(PROBE_CACHE_PATH)
+
+        self.loudness = None
+        if self.config.normalize_volume:
+            self.loudness = LoudnessAnalyzer(LOUDNESS_PATH, target=self.config.loudness_target)
+
+        # SaveVideos가 꺼져있으면 재생이 끝난 곡은 바로 지워지니 한도가 필요없다네
+        self.audio_cache = AudioCacheManager(
+            self.downloader.cache_index,
+            store=ContentStore(AUDIO_CACHE_PATH),
+            sidecars=[sidecar for sidecar in (self.opus_cache, self.loudness, self.probes) if sidecar],
+            max_bytes=self.config.cache_max_size * 1024 * 1024 if self.config.save_videos else 0,
+            max_files=self.config.cache_max_files if self.config.save_videos else 0,
+            protected=self._audio_files_in_use,
+            stats_file=AUDIO_CACHE_STATS_PATH
+        )
 
         self._setup_logging()
 
@@ -150,6 +185,19 @@ class MusicBot(discord.Client):
                 server.members if server else self.get_all_members()
             )
 
+    def _audio_files_in_use(self):
+        """
+        재생목록에 있거나 재생중인 곡들의 파일 이름이라네. 음악 저장소를 비울때 이 파일들은 지우면 안된다네.
+        """
+        for player in self.players.values():
+            entries = list(player.playlist.entries)
+            if player.current_entry:
+                entries.append(player.current_entry)
+
+            for entry in entries:
+                yield entry.filename
+                yield getattr(entry, 'expected_filename', None)
+
     def _delete_old_audiocache(self, path=AUDIO_CACHE_PATH):
         try:
             shutil.rmtree(path)
@@ -515,10 +563,18 @@ class MusicBot(discord.Client):
             return
 
         if server.id in self.players:
-            self.players.pop(server.id).kill()
+            self._kill_player(server)
 
         await vc.disconnect()
 
+    def _kill_player(self, server):
+        saving = self.players.pop(server.id).kill()
+
+        if saving is not None:
+            # 종료할 때 끝까지 기다려야 하니 저장중인 요청 목록을 기억해둔다네
+            self.queue_saves.add(saving)
+            saving.add_done_callback(self.queue_saves.discard)
+
     async def disconnect_all_voice_clients(self):
         for vc in list(self.voice_clients).copy():
             await self.disconnect_voice_client(vc.channel.server)
@@ -575,23 +631,25 @@ class MusicBot(discord.Client):
                        .on('pause', self.on_player_pause) \
                        .on('stop', self.on_player_stop) \
                        .on('finished-playing', self.on_player_finished_playing) \
-                       .on('entry-added', self.on_player_entry_added) \
                        .on('error', self.on_player_error)
 
         player.skip_state = SkipState()
 
         if server:
             self.players[server.id] = player
+            self._attach_journal(player, server)
 
         return player
 
     async def on_player_play(self, player, entry):
 
+        if entry.filename in self.downloader.cache_index:
+            self.audio_cache.touch(entry.filename, played=True)
+
         await self.update_now_playing_status(entry)
         player.skip_state.reset()
 
-        # This is the one event where its ok to serialize autoplaylist entries
-        await self.serialize_queue(player.voice_client.channel.server)
+        self._journal_current(player)
 
         channel = entry.meta.get('channel', None)
         author = entry.meta.get('author', None)
@@ -634,6 +692,8 @@ class MusicBot(discord.Client):
         await self.update_now_playing_status()
 
     async def on_player_finished_playing(self, player, **_):
+        self._journal_current(player)
+
         if not player.playlist.entries and not player.current_entry and self.config.auto_playlist:
             if not self.autoplaylist_session:
                 log.info("자동재생 목록이 비어있다네! 재생목록에서 불러오는 중이라네.")
@@ -647,7 +707,9 @@ class MusicBot(discord.Client):
                 info = {}
 
                 try:
-                    info = await self.downloader.extract_info(player.playlist.loop, song_url, download=False, process=False)
+                    info = await self.downloader.extract_info(
+                        player.playlist.loop, song_url, download=False, process=False,
+                        priority=downloader.PRIORITY_PREFETCH)
                 except downloader.youtube_dl.utils.DownloadError as e:
                     if 'YouTube said:' in e.args[0]:
                         # url is bork, remove from list and put in removed list
@@ -688,13 +750,6 @@ class MusicBot(discord.Client):
                 log.warning("자동재생 목록에서 실행 가능한 곡이 없는것같다네. 사용을 해제하겠네.")
                 self.config.auto_playlist = False
 
-        else: # Don't serialize for autoplaylist events
-            await self.serialize_queue(player.voice_client.channel.server)
-
-    async def on_player_entry_added(self, player, playlist, entry, **_):
-        if entry.meta.get('author') and entry.meta.get('channel'):
-            await self.serialize_queue(player.voice_client.channel.server)
-
     async def on_player_error(self, player, entry, ex, **_):
         if 'channel' in entry.meta:
             await self.safe_send_message(
@@ -763,23 +818,43 @@ class MusicBot(discord.Client):
         self.server_specific_data[server]['last_np_msg'] = m
 
 
+    def _attach_journal(self, player, server):
+        """
+        재생목록이 바뀔때마다 전부 다시 쓰지 않고 바뀐 부분만 기록하도록 기록장을 달아준다네.
+        """
+        journal = QueueJournal('data/%s/queue.journal' % server.id, player.snapshot,
+                               loop=self.loop, delay=self.config.queue_save_delay)
+        journal.flush()
+
+        player.playlist.journal = journal
+
+    def _journal_current(self, player):
+        if player.playlist.journal is not None:
+            player.playlist.journal.current(player.current_entry)
+
     async def serialize_queue(self, server, *, dir=None):
         """
         Serialize the current queue for a server's player to json.
+        Without `dir`, this writes a fresh snapshot to the server's queue journal.
         """
 
         player = self.get_player_in(server)
         if not player:
             return
 
-        if dir is None:
-            dir = 'data/%s/queue.json' % server.id
-
         async with self.aiolocks['queue_serialization'+':'+server.id]:
             log.debug("%s의 요청 목록을 직렬화 하는중이라네", server.id)
 
-            with open(dir, 'w', encoding='utf8') as f:
-                f.write(player.serialize(sort_keys=True))
+            if dir is None and player.playlist.journal is not None:
+                await player.playlist.journal.flush()
+                return
+
+            if dir is None:
+                dir = 'data/%s/queue.json' % server.id
+
+            data = player.snapshot()
+            await self.loop.run_in_executor(
+                None, lambda: write_atomic(dir, json.dumps(data, sort_keys=True)))
 
     async def serialize_all_queues(self, *, dir=None):
         coros = [self.serialize_queue(s, dir=dir) for s in self.servers]
@@ -793,17 +868,27 @@ class MusicBot(discord.Client):
         if playlist is None:
             playlist = Playlist(self)
 
+        journal = None
         if dir is None:
+            journal = 'data/%s/queue.journal' % server.id
             dir = 'data/%s/queue.json' % server.id
 
         async with self.aiolocks['queue_serialization' + ':' + server.id]:
-            if not os.path.isfile(dir):
+            if journal and os.path.isfile(journal):
+                log.debug("%s의 요청 목록 기록장을 다시 재생하는중이라네", server.id)
+                data = QueueJournal.replay(journal)
+                if data is None:
+                    return None
+
+            # 기록장이 없으면 예전 방식으로 저장된 목록을 읽는다네
+            elif not os.path.isfile(dir):
                 return None
 
-            log.debug("%s의 요청 목록을 비직렬화 하는중이라네", server.id)
+            else:
+                log.debug("%s의 요청 목록을 비직렬화 하는중이라네", server.id)
 
-            with open(dir, 'r', encoding='utf8') as f:
-                data = f.read()
+                with open(dir, 'r', encoding='utf8') as f:
+                    data = f.read()
 
         return MusicPlayer.from_json(data, self, voice_client, playlist)
 
@@ -833,10 +918,16 @@ class MusicBot(discord.Client):
 
         if not self.config.save_videos and os.path.isdir(AUDIO_CACHE_PATH):
             if self._delete_old_audiocache():
+                self.audio_cache.store.clear()
                 log.debug("오래된 음악 저장소를 정리했다네")
             else:
                 log.debug("오래된 음악 저장소를 정리할수가 없었다네. 일단 계속하겠네.")
 
+        # 음악 저장소를 한번만 훑어두고, 그 뒤로는 목록을 계속 고쳐가며 쓴다네
+        await self.downloader.cache_index.rescan(self.loop)
+        log.debug("음악 저장소에서 {} 개 파일을 찾았다네".format(len(self.downloader.cache_index)))
+        self.audio_cache.schedule_eviction(self.loop)
+
 
     async def _scheck_server_permissions(self):
         log.debug("서버 권한을 확인하는 중이라네")
@@ -940,6 +1031,28 @@ class MusicBot(discord.Client):
             self.loop.run_until_complete(self.logout())
         except: pass
 
+        try:
+            self.downloader.shutdown()
+        except: pass
+
+        try:
+            self.audio_cache.save_usage()
+        except: pass
+
+        try:
+            if self.opus_cache:
+                self.opus_cache.shutdown()
+        except: pass
+
+        try:
+            if self.loudness:
+                self.loudness.shutdown()
+        except: pass
+
+        try:
+            self.probes.shutdown()
+        except: pass
+
         pending = asyncio.Task.all_tasks()
         gathered = asyncio.gather(*pending)
 
@@ -974,9 +1087,28 @@ class MusicBot(discord.Client):
                 raise self.exit_signal
 
     async def logout(self):
+        # 나가면서 저장을 시작한 요청 목록까지 기다려야 하니 먼저 연결을 끊는다네
         await self.disconnect_all_voice_clients()
+        await self._flush_queues()
         return await super().logout()
 
+    async def _flush_queues(self):
+        """
+        모든 서버의 요청 목록을 한꺼번에 저장하고, 정해진 시간까지만 기다린다네.
+        이미 나간 서버들의 요청 목록이 아직 저장중이면 그것도 같이 기다린다네.
+        """
+        flushes = [player.playlist.journal.flush() for player in self.players.values()
+                   if player.playlist.journal is not None]
+        flushes.extend(self.queue_saves)
+        if not flushes:
+            return
+
+        timeout = self.config.queue_save_timeout or None
+        done, pending = await asyncio.wait(flushes, timeout=timeout)
+
+        if pending:
+            log.warning("%s개 서버의 요청 목록을 %s초 안에 저장하지 못했다네", len(pending), timeout)
+
     async def on_error(self, event, *args, **kwargs):
         ex_type, ex, stack = sys.exc_info()
 
@@ -1125,6 +1257,9 @@ class MusicBot(discord.Client):
             log.info("    삭제 호출: " + ['거짓', '참'][self.config.delete_invoking])
         log.info("  디버그 모드: " + ['거짓', '참'][self.config.debug_mode])
         log.info("  음악들은 " + ['저장이 안된다네', '저장된다네'][self.config.save_videos])
+        if self.config.save_videos and (self.config.cache_max_size or self.config.cache_max_files):
+            log.info("    저장소 한도: {} MB, {} 개 파일".format(
+                self.config.cache_max_size or '무제한', self.config.cache_max_files or '무제한'))
         if self.config.status_message:
             log.info("  상태 메시지: " + self.config.status_message)
         print(flush=True)
@@ -1298,66 +1433,13 @@ class MusicBot(discord.Client):
             # TODO: Possibly add another check here to see about things like the bandcamp issue
             # TODO: Where ytdl gets the generic extractor version with no processing, but finds two different urls
             if 'entries' in info:
-                
-                # The only reason we would use this over `len(info['entries'])` is if we add `if _` to this one
-                num_songs = sum(1 for _ in info['entries'])
-                if info['extractor'].lower() in ['youtube:playlist', 'soundcloud:set', 'bandcamp:album']:
-                    try:
-                        return await self._cmd_playlist_async(player, channel, author, song_url, info['extractor'])
-                    except exceptions.CommandError:
-                        raise
-                    except Exception as e:
-                        log.error("재생목록에 추가하는데 실패했다네.", exc_info=True)
-                        raise exceptions.CommandError("재생목록에 추가 실패:\n%s" % e, expire_in=30)
-
-                t0 = time.time()
-
-                # My test was 1.2 seconds per song, but we maybe should fudge it a bit, unless we can
-                # monitor it and edit the message with the estimated time, but that's some ADVANCED SHIT
-                # I don't think we can hook into it anyways, so this will have to do.
-                # It would probably be a thread to check a few playlists and get the speed from that
-                # Different playlists might download at different speeds though
-                wait_per_song = 1.2
-
-                procmesg = await self.safe_send_message(
-                    channel,
-                    '{} 개 곡에 대하여 정보를 모으는중이라네!{}'.format(
-                        num_songs,
-                        ', 예상시간: {} 초'.format(fixg(
-                            num_songs * wait_per_song)) if num_songs >= 10 else '.'))
-
-                # We don't have a pretty way of doing this yet.  We need either a loop
-                # that sends these every 10 seconds or a nice context manager.
-                await self.send_typing(channel)
-
-                # TODO: I can create an event emitter object instead, add event functions, and every play list might be asyncified
-                #       Also have a "verify_entry" hook with the entry as an arg and returns the entry if its ok
-
-                entry_list, position = await player.playlist.import_from(song_url, channel=channel, author=author)
-
-                tnow = time.time()
-                ttime = tnow - t0
-                listlen = len(entry_list)
-                drop_count = 0
-
-                log.info("{} 개 곡을 {} 초에, {:.2f}초/곡 으로 처리 완료했다네!, {:+.2g}/곡 의 예상시간은 ({}초)".format(
-                    listlen,
-                    fixg(ttime),
-                    ttime / listlen if listlen else 0,
-                    ttime / listlen - wait_per_song if listlen - wait_per_song else 0,
-                    fixg(wait_per_song * num_songs))
-                )
-
-                await self.safe_delete_message(procmesg)
-
-                if not listlen - drop_count:
-                    raise exceptions.CommandError(
-                        "추가된 곡이 없다네! \n모든 곡이 최대 대기시간을 넘어갔다네. ",
-                        expire_in=30
-                    )
-
-                reply_text = "**%s** 개 곡을 재생목록에 추가했다네. \n재생목록에서의 현재 위치는 %s번 이라네!"
-                btext = str(listlen - drop_count)
+                try:
+                    return await self._cmd_playlist_async(player, channel, author, song_url, info['extractor'])
+                except exceptions.CommandError:
+                    raise
+                except Exception as e:
+                    log.error("재생목록에 추가하는데 실패했다네.", exc_info=True)
+                    raise exceptions.CommandError("재생목록에 추가 실패:\n%s" % e, expire_in=30)
 
             else:
                 try:
@@ -1404,69 +1486,83 @@ class MusicBot(discord.Client):
             raise exceptions.CommandError("그 재생목록은 재생할수 없을것같다네.")
 
         num_songs = sum(1 for _ in info['entries'])
+        del info
         t0 = time.time()
 
         busymsg = await self.safe_send_message(
             channel, "%s 개 곡 처리중." % num_songs)  # TODO: From playlist_title
         await self.send_typing(channel)
 
-        entries_added = 0
-        if extractor_type == 'youtube:playlist':
-            try:
+        progress = {'done': 0, 'added': 0, 'failed': 0}
+
+        def on_import_progress(playlist, source, done, added, failed, **_):
+            if source == playlist_url:
+                progress.update(done=done, added=added, failed=failed)
+
+        player.playlist.on('import-progress', on_import_progress)
+        updater = asyncio.ensure_future(
+            self._update_import_progress(busymsg, num_songs, progress, t0), loop=self.loop)
+
+        entries_added = []
+        try:
+            if extractor_type == 'youtube:playlist':
                 entries_added = await player.playlist.async_process_youtube_playlist(
                     playlist_url, channel=channel, author=author)
-                # TODO: Add hook to be called after each song
-                # TODO: Add permissions
 
-            except Exception:
-                log.error("재생목록을 처리하는데 문제가 생겼다네.", exc_info=True)
-                raise exceptions.CommandError('재생목록에 %s 추가하는데 문제가 생긴것같다네.' % playlist_url, expire_in=30)
-
-        elif extractor_type.lower() in ['soundcloud:set', 'bandcamp:album']:
-            try:
+            elif extractor_type.lower() in ['soundcloud:set', 'bandcamp:album']:
                 entries_added = await player.playlist.async_process_sc_bc_playlist(
                     playlist_url, channel=channel, author=author)
-                # TODO: Add hook to be called after each song
-                # TODO: Add permissions
-
-            except Exception:
-                log.error("재생목록을 처리하는데 문제가 생겼다네.", exc_info=True)
-                raise exceptions.CommandError('재생목록에 %s 추가하는데 문제가 생긴것같다네.' % playlist_url, expire_in=30)
 
+            else:
+                entries_added = await player.playlist.stream_import_from(
+                    playlist_url, channel=channel, author=author)
 
-        songs_processed = len(entries_added)
-        drop_count = 0
-        skipped = False
+        except Exception:
+            log.error("재생목록을 처리하는데 문제가 생겼다네.", exc_info=True)
+            raise exceptions.CommandError('재생목록에 %s 추가하는데 문제가 생긴것같다네.' % playlist_url, expire_in=30)
 
-        await self.safe_delete_message(busymsg)
+        finally:
+            player.playlist.off('import-progress', on_import_progress)
+            updater.cancel()
+            await self.safe_delete_message(busymsg)
 
         songs_added = len(entries_added)
-        tnow = time.time()
-        ttime = tnow - t0
-        wait_per_song = 1.2
-        # TODO: actually calculate wait per song in the process function and return that too
+        ttime = time.time() - t0
 
-        # This is technically inaccurate since bad songs are ignored but still take up time
-        
-        log.info("{} 개 곡을 {} 초에, {:.2f}초/곡 으로 처리 완료했다네!\n {:+.2g}/곡 의 예상시간은 ({}초)".format(
-            songs_processed,
+        log.info("{}/{} 개 곡을 {} 초에, {:.2f}초/곡 으로 처리 완료했다네! (실패 {} 곡)".format(
+            songs_added,
             num_songs,
             fixg(ttime),
             ttime / num_songs if num_songs else 0,
-            ttime / num_songs - wait_per_song if num_songs - wait_per_song else 0,
-            fixg(wait_per_song * num_songs))
+            progress['failed'])
         )
 
         if not songs_added:
-            basetext = "추가된 곡이 없다네! \n모든 곡이 최대 대기시간을 넘어갔다네."
-            if skipped:
-                basetext += "\n그리고, 현재 곡은 너무 길어서 건너뛰었다네."
-
-            raise exceptions.CommandError(basetext, expire_in=30)
+            raise exceptions.CommandError("추가된 곡이 없다네! \n모든 곡이 최대 대기시간을 넘어갔다네.", expire_in=30)
 
         return Response("추가된 {} 곡들은 {} 초 후에 시작될 예정이라네!".format(
             songs_added, fixg(ttime, 1)), delete_after=15)
-    
+
+    async def _update_import_progress(self, message, total, progress, t0, *, interval=3):
+        """
+        재생목록을 가져오는 동안 진행상황 메세지를 주기적으로 고쳐준다네.
+        남은 시간은 지금까지 걸린 시간으로 계산한다네.
+        """
+
+        shown = None
+        while True:
+            await asyncio.sleep(interval)
+
+            done = progress['done']
+            if not done or done == shown:
+                continue
+            shown = done
+
+            eta = (time.time() - t0) / done * (total - done)
+            text = "{}/{} 개 곡 처리중. (추가 {}, 실패 {}) 남은시간 약 {} 초".format(
+                done, total, progress['added'], progress['failed'], fixg(eta))
+
+            await self.safe_edit_message(message, text, quiet=True)
 
     async def cmd_np(self, player, channel, server, message):
         """
@@ -1512,6 +1608,12 @@ class MusicBot(discord.Client):
 
             self.server_specific_data[server]['last_np_msg'] = await self.safe_send_message(channel, np_text)
             await self._manual_delete_check(message)
+        elif player.playlist.loading_entry:
+            entry = player.playlist.loading_entry
+            return Response(
+                '저장중: **{title}** {progress}'.format(title=entry.title, progress=self._format_download_progress(entry)),
+                delete_after=15
+            )
         else:
             return Response(
                 '재생목록에 추가된 곡이 없다네! \n{}재생을 사용해서 곡을 추가해주겠나.'.format(self.config.command_prefix),
@@ -1519,6 +1621,19 @@ class MusicBot(discord.Client):
             )
     cmd_지금곡 = cmd_재생중 = cmd_nowplaying = cmd_np
 
+    def _format_download_progress(self, entry):
+        progress = entry.progress
+        if not progress:
+            return '`[대기중]`'
+
+        parts = ['{:.1f}MB'.format(progress['bytes'] / 1024 / 1024)]
+        if progress['percent'] is not None:
+            parts.append('{:.0f}%'.format(progress['percent']))
+        if progress['eta'] is not None:
+            parts.append('{} 남음'.format(ftimedelta(timedelta(seconds=progress['eta']))))
+
+        return '`[{}]`'.format(' / '.join(parts))
+
     async def cmd_summon(self, channel, server, author, voice_channel):
         """
         사용법:
@@ -1662,9 +1777,13 @@ class MusicBot(discord.Client):
         if player.is_stopped:
             raise exceptions.CommandError("곡을 건너뛸수 없다네. \n재생중인 곡이 없는것 같네!", expire_in=20)
 
-        if not player.current_entry:
+        # 저장중인 곡은 저장이 끝나길 기다리는 대신 저장을 그만두고 그 다음 곡으로 넘어간다네
+        entry = player.current_entry or player.playlist.loading_entry
+        loading = entry is not None and entry is not player.current_entry
+
+        if not entry:
             if player.playlist.peek():
-                if player.playlist.peek()._is_downloading:
+                if player.playlist.peek().is_downloading:
                     return Response("다음 곡인 (%s) 저장중이라네! 기다려주겠나." % player.playlist.peek().title)
                 elif player.playlist.peek().is_downloaded:
                     print("다음 곡이 곧 시작될거라네! \n잠시만 기다려주겠나.")
@@ -1679,10 +1798,12 @@ class MusicBot(discord.Client):
         await self.cmd_clean(message, channel, channel.server, author)
         await self.cmd_queue(channel, player)
         if author.id == self.config.owner_id \
-                or author == player.current_entry.meta.get('author', None):
+                or author == entry.meta.get('author', None):
 
             player.skip()  # check autopause stuff here
             await self._manual_delete_check(message)
+            if loading:
+                return Response("저장중이던 (%s) 곡을 건너뛰었다네." % entry.title, delete_after=10)
             return
 
         # TODO: ignore person if they're deaf or take them out of the list or something?
@@ -1694,6 +1815,8 @@ class MusicBot(discord.Client):
         num_skips = player.skip_state.add_skipper(author.id, message)
 
         player.skip()  # check autopause stuff here        
+        if loading:
+            return Response("저장중이던 (%s) 곡을 건너뛰었다네." % entry.title, delete_after=10)
         '''
         return Response(
             '**{}** 곡을 건너뛰겠네.'
@@ -1910,6 +2033,37 @@ class MusicBot(discord.Client):
         return Response("\N{OPEN MAILBOX WITH RAISED FLAG}", delete_after=10)
     cmd_권한 = cmd_perms
 
+    @owner_only
+    async def cmd_stats(self, server):
+        """
+        사용법:
+            {command_prefix}stats
+
+        별칭:
+            {command_prefix}통계
+
+        곡 정보를 알아보고 받는 작업들과 캐시가 얼마나 잘 돌아가고 있는지 보여준다네.
+        """
+
+        sections = [('%s 작업' % lane['lane'], lane) for lane in self.downloader.lane_stats()]
+        sections.append(('곡 정보 캐시', self.downloader.info_cache.stats()))
+        sections.append(('검색 캐시', self.downloader.search_cache.stats()))
+        sections.append(('오디오 캐시', self.audio_cache.stats()))
+
+        player = self.get_player_in(server)
+        if player:
+            sections.append(('이 서버의 미리 받기', player.playlist.prefetch_stats()))
+
+        lines = ['```']
+        for title, stats in sections:
+            lines.append('[%s]' % title)
+            lines.extend('  %s: %s' % (key, '%.2f' % value if isinstance(value, float) else value)
+                         for key, value in stats.items() if key != 'lane')
+        lines.append('```')
+
+        return Response('\n'.join(lines), delete_after=60)
+    cmd_통계 = cmd_stats
+
     @owner_only
     async def cmd_setname(self, leftover_args, name):
         """
@@ -2329,7 +2483,7 @@ class MusicBot(discord.Client):
         [log.debug(' - ' + s.name) for s in self.servers]
 
         if server.id in self.players:
-            self.players.pop(server.id).kill()
+            self._kill_player(server)
 
 
     async def on_server_available(self, server: discord.Server):
@@ -2398,6 +2552,30 @@ class MusicBot(discord.Client):
         return Response('안녕하신가. %s!'%author, delete_after=10)
     cmd_하이 = cmd_안냥 = cmd_안녕    
 
+    def _prefetch_search_results(self, player, urls):
+        """
+        검색 결과를 고르는 동안 후보들의 정보를 미리 알아둔다네. 설정에 따라 첫번째 곡은 미리 받아두기도 한다네.
+        """
+        if not self.config.search_predownload or not urls:
+            return self.downloader.prefetch_info(player.playlist.loop, urls)
+
+        # 받아둔 파일은 다른 곡들처럼 캐시에 기록되니 안 고르면 나중에 알아서 지워진다네
+        first = asyncio.ensure_future(self._predownload(player, urls[0]), loop=self.loop)
+        return [first] + self.downloader.prefetch_info(player.playlist.loop, urls[1:])
+
+    async def _predownload(self, player, url):
+        try:
+            await player.playlist.predownload(url)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.debug("{}를 미리 받아두지 못했다네: {}".format(url, e))
+
+    def _cancel_prefetches(self, prefetches, keep=None):
+        for i, task in enumerate(prefetches):
+            if i != keep:
+                task.cancel()
+
     #### 커스텀 Play 명령어!
     async def cmd_시작(self, player, channel, author, message, leftover_args):
         """
@@ -2479,7 +2657,8 @@ class MusicBot(discord.Client):
         search_msg = await self.send_message(channel, "동영상을 찾는중이라네.")
         await self.send_typing(channel)
         try:
-            info = await self.downloader.dev_ytbsearch_custom(player.playlist.loop, *leftover_args, download=False, process=True)
+            info = await self.downloader.dev_ytbsearch_custom(
+                player.playlist.loop, *leftover_args, session=self.aiosession, max_results=items_requested)
 
         except Exception as e:
             await self.safe_edit_message(search_msg, str(e), send_if_fail=True)
@@ -2496,9 +2675,19 @@ class MusicBot(discord.Client):
             msg += str(num) + '  :  '+ tup[1] + ' & 재생시간:' +  tup[2]+ '\n'
           
         result_message = await self.safe_send_message(channel,'%s\n\n결과물이라네!'%msg, delete_after=10)
-        res = await self.wait_for_message(author=author, timeout=30)
-        
+
+        # 고르는 동안 후보들을 미리 알아봐둔다네
+        ytbprefix = 'https://www.youtube.com'
+        prefetches = self._prefetch_search_results(player, [ytbprefix + tup[0] for tup in info])
+
+        try:
+            res = await self.wait_for_message(author=author, timeout=30)
+        except:
+            self._cancel_prefetches(prefetches)
+            raise
+
         if not res:
+            self._cancel_prefetches(prefetches)
             await self.safe_delete_message(result_message)
             await self.cmd_clean(message, channel, message.server, author, 2)
             return Response("20초가 지났다네. 다시 질문해주겠나!", delete_after=20)
@@ -2506,15 +2695,17 @@ class MusicBot(discord.Client):
         try:
             int(command)
         except ValueError:
+            self._cancel_prefetches(prefetches)
             await self.safe_delete_message(result_message)
             return Response("말한건 {} 부터 {} 사이의 숫자가 아닌것같다네".format('0', str(num)), delete_after=10)
+
+        self._cancel_prefetches(prefetches, keep=int(command) - 1)
         
         #await self.safe_delete_message(res)
         await self.safe_delete_message(result_message)
         await self.cmd_clean(message, channel, message.server, author)
         newmsg = ''
         if int(command) > 0 and int(command) < num + 1 :
-            ytbprefix = 'https://www.youtube.com'
             if res:
                 await self.cmd_oldplay(player, channel, author, [], song_url = str(ytbprefix+str(info[int(res.content[len(self.config.command_prefix):].lower().strip())-1][0])))
                 newmsg = "바로 시작하겠네!"
@@ -2736,7 +2927,8 @@ class MusicBot(discord.Client):
         search_msg = await self.send_message(channel, "동영상을 찾는중이라네.")
         await self.send_typing(channel)
         try:
-            info = await self.downloader.dev_ytbsearch_custom(player.playlist.loop, *leftover_args, download=False, process=True)
+            info = await self.downloader.dev_ytbsearch_custom(
+                player.playlist.loop, *leftover_args, session=self.aiosession, max_results=items_requested)
 
         except Exception as e:
             await self.safe_edit_message(search_msg, str(e), send_if_fail=True)
@@ -2754,9 +2946,18 @@ class MusicBot(discord.Client):
           
         result_message = await self.safe_send_message(channel,'%s\n\n결과물이라네!'%msg, delete_after=10)
 
-        res = await self.wait_for_message(author=author, timeout=30)
-        
+        # 고르는 동안 후보들을 미리 알아봐둔다네
+        ytbprefix = 'https://www.youtube.com'
+        prefetches = self._prefetch_search_results(player, [ytbprefix + tup[0] for tup in info])
+
+        try:
+            res = await self.wait_for_message(author=author, timeout=30)
+        except:
+            self._cancel_prefetches(prefetches)
+            raise
+
         if not res:
+            self._cancel_prefetches(prefetches)
             await self.safe_delete_message(result_message)
             await self.cmd_clean(message, channel, message.server, author, 2)
             return Response("20초가 지났다네. 다시 질문해주겠나!", delete_after=20)
@@ -2768,10 +2969,12 @@ class MusicBot(discord.Client):
         try:
             int(command)
         except ValueError:
+            self._cancel_prefetches(prefetches)
             await self.safe_delete_message(result_message)
             return Response("말한건 {} 부터 {} 사이의 숫자가 아닌것같다네".format('0', str(num)), delete_after=10)
+
+        self._cancel_prefetches(prefetches, keep=int(command) - 1)
         if int(command) > 0 and int(command) < num + 1 :
-            ytbprefix = 'https://www.youtube.com'
             song_url = str(ytbprefix+str(info[int(res.content[len(self.config.command_prefix):].lower().strip())-1][0]))
             async with self.aiolocks[_func_() + ':' + author.id]:
                 try:
@@ -0,0 +1,912 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import shutil
+import threading
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import md5sum
+from .lib.ogg import OggOpusReader
+
+log = logging.getLogger(__name__)
+
+# Files ytdl leaves behind while it's still working on a download
+_partial_suffixes = ('.part', '.ytdl', '.temp', '.tmp')
+
+
+class AudioCacheIndex:
+    """
+        In-memory index of the audio cache folder, so checking whether a song is already downloaded doesn't
+        have to list the whole folder every time.
+
+        The folder is scanned once, off the event loop, and then kept up to date with `add` and `discard`
+        as downloads finish and files get deleted.  Lookups are dict hits:
+
+          - by file name, `youtube-9R8aSKwTEMg-NOMA_-_Brain_Power.m4a`
+          - by stem, `youtube-9R8aSKwTEMg-NOMA_-_Brain_Power`, when ytdl picked a different extension
+          - by prefix, everything before the last `-`, for generic downloads with a hash suffix
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._files = {}
+        self._mtimes = {}
+        self._by_stem = {}
+        self._by_prefix = {}
+        self._scan = None
+
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, filename):
+        return os.path.basename(filename) in self._files
+
+    def __iter__(self):
+        return iter(list(self._files))
+
+    @property
+    def scanned(self):
+        return self._scan is not None and self._scan.done()
+
+    def scan(self, loop):
+        """
+            Scans the folder in the default executor.  Returns a future that's shared by every caller, so
+            the folder is only ever listed once.  Use `rescan` to list it again.
+        """
+
+        if self._scan is None:
+            self._scan = asyncio.ensure_future(self._do_scan(loop), loop=loop)
+
+        return asyncio.shield(self._scan)
+
+    def rescan(self, loop):
+        self._scan = None
+        return self.scan(loop)
+
+    async def _do_scan(self, loop):
+        names = await loop.run_in_executor(None, self._list_folder)
+
+        for name, size, mtime in names:
+            self._add(name, size, mtime)
+
+        log.debug("Indexed {} files in {}".format(len(self._files), self.folder))
+
+    def _list_folder(self):
+        try:
+            return [(e.name, e.stat().st_size, e.stat().st_mtime)
+                    for e in os.scandir(self.folder) if e.is_file() and _cacheable(e.name)]
+
+        except FileNotFoundError:
+            return []
+
+    def clear(self):
+        self._files.clear()
+        self._mtimes.clear()
+        self._by_stem.clear()
+        self._by_prefix.clear()
+        self.total_bytes = 0
+
+    def add(self, filename):
+        """
+            Records a file that was just written to the cache folder.
+        """
+
+        name = os.path.basename(filename)
+        if not _cacheable(name):
+            return
+
+        try:
+            stat = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            log.debug("Not indexing missing file {}".format(name))
+            return
+
+        self._add(name, stat.st_size, stat.st_mtime)
+
+    def discard(self, filename):
+        """
+            Forgets a file that was deleted from the cache folder.  Unknown files are ignored.
+        """
+
+        name = os.path.basename(filename)
+        size = self._files.pop(name, None)
+        if size is None:
+            return
+
+        self.total_bytes -= size
+        self._mtimes.pop(name, None)
+
+        for mapping, key in ((self._by_stem, _stem(name)), (self._by_prefix, _prefix(name))):
+            names = mapping.get(key)
+            if names:
+                names.discard(name)
+                if not names:
+                    del mapping[key]
+
+    def size_of(self, filename):
+        return self._files.get(os.path.basename(filename))
+
+    def mtime_of(self, filename):
+        return self._mtimes.get(os.path.basename(filename))
+
+    def find(self, expected_filename):
+        """
+            Returns the path of the cached copy of `expected_filename`, allowing for a different extension,
+            or None if it isn't cached.
+        """
+
+        name = os.path.basename(expected_filename)
+
+        if name in self._files:
+            return self._verified(name)
+
+        for candidate in sorted(self._by_stem.get(_stem(name), ())):
+            found = self._verified(candidate)
+            if found:
+                return found
+
+    def find_prefix(self, prefix):
+        """
+            Returns the path of a cached file named `<prefix>-<anything>`, or None.
+        """
+
+        for candidate in sorted(self._by_prefix.get(prefix, ())):
+            found = self._verified(candidate)
+            if found:
+                return found
+
+    def _add(self, name, size, mtime):
+        self.total_bytes += size - self._files.get(name, 0)
+        self._files[name] = size
+        self._mtimes[name] = mtime
+        self._by_stem.setdefault(_stem(name), set()).add(name)
+        self._by_prefix.setdefault(_prefix(name), set()).add(name)
+
+    def _verified(self, name):
+        # Someone may have cleaned the folder by hand, a stat is still a lot cheaper than a listdir
+        path = os.path.join(self.folder, name)
+
+        if os.path.isfile(path):
+            return path
+
+        log.debug("Cached file {} disappeared, dropping it from the index".format(name))
+        self.discard(name)
+
+
+class ContentStore:
+    """
+        Content addressed storage for the audio cache.  Every distinct download is kept once, as
+        `<folder>/.objects/<md5>`, and files in the cache folder with the same content are hard links to it,
+        so a song downloaded under two different names only takes up space once.
+
+        Keeps a file name -> md5 index in `.objects/index.json`.  When the last name pointing at an object
+        is released, the object is deleted too.  If the filesystem can't do hard links, files are left as
+        they are and the store does nothing.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.objects_folder = os.path.join(folder, '.objects')
+        self.index_file = os.path.join(self.objects_folder, 'index.json')
+
+        self.deduplicated = 0
+        self.bytes_deduplicated = 0
+
+        self._names = {}
+        self._lock = threading.Lock()
+        self._links_work = True
+
+        self._load()
+
+    def __len__(self):
+        return len(set(self._names.values()))
+
+    def digest_of(self, filename):
+        return self._names.get(os.path.basename(filename))
+
+    def add(self, filename, digest):
+        """
+            Files `filename` under `digest`.  If the content is already stored, `filename` is replaced with a
+            link to the stored copy.  Does blocking io, call it from an executor.
+        """
+
+        if not self._links_work:
+            return
+
+        name = os.path.basename(filename)
+        path = os.path.join(self.folder, name)
+        obj = os.path.join(self.objects_folder, digest)
+
+        try:
+            os.makedirs(self.objects_folder, exist_ok=True)
+
+            if not os.path.exists(obj):
+                os.link(path, obj)
+
+            elif not os.path.samefile(obj, path):
+                size = os.path.getsize(path)
+
+                # Swap the fresh copy for a link to the stored one without a moment where the name is missing
+                tmp = path + '.dedup'
+                os.link(obj, tmp)
+                os.replace(tmp, path)
+
+                with self._lock:
+                    self.deduplicated += 1
+                    self.bytes_deduplicated += size
+
+                log.debug("{} is a duplicate of {}, linked it instead".format(name, digest))
+
+        except OSError as e:
+            log.warning("Could not add {} to the content store, disabling deduplication ({})".format(name, e))
+            self._links_work = False
+            return
+
+        with self._lock:
+            self._names[name] = digest
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+
+    def release(self, filename):
+        """
+            Forgets a file that was deleted from the cache folder, and deletes its object if nothing else
+            links to it anymore.  Does blocking io, call it from an executor.
+        """
+
+        with self._lock:
+            digest = self._names.pop(os.path.basename(filename), None)
+
+        if digest is None:
+            return
+
+        obj = os.path.join(self.objects_folder, digest)
+        try:
+            if os.stat(obj).st_nlink <= 1:
+                os.unlink(obj)
+                log.debug("Deleted unreferenced object {}".format(digest))
+
+        except FileNotFoundError:
+            pass
+
+        except OSError:
+            log.debug("Could not clean up object {}".format(digest), exc_info=True)
+
+    def _load(self):
+        if not os.path.isfile(self.index_file):
+            return
+
+        try:
+            with open(self.index_file, encoding='utf8') as f:
+                self._names = json.load(f)
+
+        except Exception:
+            log.warning("Could not load the content store index from {}".format(self.index_file), exc_info=True)
+
+    def save(self):
+        if not self._names:
+            return
+
+        with self._lock:
+            names = dict(self._names)
+
+        try:
+            tmp = self.index_file + '.tmp'
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump(names, f)
+            os.replace(tmp, self.index_file)
+
+        except Exception:
+            log.warning("Could not save the content store index to {}".format(self.index_file), exc_info=True)
+
+
+class OpusCache:
+    """
+        Keeps an Ogg/Opus copy of cached songs in `folder`, encoded at discord's frame size (20ms, 48kHz stereo),
+        so the player can send the packets as they are instead of running ffmpeg and the opus encoder on
+        every play.
+
+        Transcoding is done by ffmpeg in a single background thread at a low priority, once per song.
+    """
+
+    bitrate = 128
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.transcoded = 0
+        self.failed = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = set()
+
+    def path_for(self, filename):
+        return os.path.join(self.folder, os.path.basename(filename) + '.opus')
+
+    def open(self, filename):
+        """
+            Returns an OggOpusReader for `filename`'s opus copy, or None if there isn't a usable one yet.
+        """
+
+        path = self.path_for(filename)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            return OggOpusReader(path)
+        except Exception:
+            log.warning("Opus copy of {} is unusable, deleting it".format(filename), exc_info=True)
+            self.remove(filename)
+
+    def schedule(self, loop, filename):
+        """
+            Queues `filename` to be transcoded if it doesn't have an opus copy yet.
+        """
+
+        name = os.path.basename(filename)
+        if name in self._pending or os.path.isfile(self.path_for(name)):
+            return
+
+        self._pending.add(name)
+        future = loop.run_in_executor(self._executor, self._transcode, filename)
+        future.add_done_callback(lambda f: self._pending.discard(name))
+
+    def remove(self, filename):
+        try:
+            os.unlink(self.path_for(filename))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            log.debug("Could not delete the opus copy of {}".format(filename), exc_info=True)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _transcode(self, filename):
+        path = self.path_for(filename)
+        tmp = path + '.tmp'
+
+        args = [
+            'ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', filename,
+            '-map', '0:a:0', '-vn', '-ar', '48000', '-ac', '2',
+            '-c:a', 'libopus', '-b:a', '{}k'.format(self.bitrate), '-frame_duration', '20', '-application', 'audio',
+            '-f', 'ogg', tmp
+        ]
+
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+                           preexec_fn=_lower_priority if os.name == 'posix' else None)
+            os.replace(tmp, path)
+
+        except subprocess.CalledProcessError as e:
+            self.failed += 1
+            log.warning("Could not transcode {} to opus: {}".format(
+                filename, e.stderr.decode('utf8', 'replace').strip()))
+
+        except OSError:
+            self.failed += 1
+            log.warning("Could not transcode {} to opus".format(filename), exc_info=True)
+
+        else:
+            self.transcoded += 1
+            log.debug("Transcoded {} to opus".format(filename))
+            return
+
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+class LoudnessAnalyzer:
+    """
+        Measures the integrated loudness and true peak of cached songs with ffmpeg's ebur128 filter, once per
+        song, in a single low-priority background thread.  Results are kept in `results_file`.
+
+        `gain_for` turns a measurement into a volume multiplier that brings the song to `target` LUFS without
+        pushing its peak over -1 dBFS, for the player to fold into its volume.
+    """
+
+    max_boost = 10
+    max_cut = 20
+    save_every = 20
+
+    def __init__(self, results_file=None, *, target=-14):
+        self.results_file = results_file
+        self.target = target
+
+        self._results = {}
+        self._pending = set()
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self._load()
+
+    def __len__(self):
+        return len(self._results)
+
+    def measurement(self, filename):
+        """
+            Returns (integrated LUFS, true peak dBFS) for `filename`, or None if it hasn't been measured.
+        """
+
+        return self._results.get(os.path.basename(filename))
+
+    def gain_for(self, filename):
+        measured = self.measurement(filename)
+        if not measured:
+            return 1.0
+
+        integrated, peak = measured
+        if integrated <= -70:
+            # Silence, or close enough that there's nothing to normalize
+            return 1.0
+
+        gain_db = self.target - integrated
+        gain_db = min(gain_db, -1 - peak, self.max_boost)
+        gain_db = max(gain_db, -self.max_cut)
+
+        return 10 ** (gain_db / 20)
+
+    def schedule(self, loop, filename):
+        """
+            Queues `filename` to be measured if it hasn't been yet.
+        """
+
+        name = os.path.basename(filename)
+        if name in self._pending or name in self._results:
+            return
+
+        self._pending.add(name)
+        future = loop.run_in_executor(self._executor, self._analyze, filename)
+        future.add_done_callback(lambda f: self._pending.discard(name))
+
+    def remove(self, filename):
+        with self._lock:
+            self._results.pop(os.path.basename(filename), None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self.save()
+
+    def _analyze(self, filename):
+        args = ['ffmpeg', '-nostdin', '-nostats', '-threads', '1', '-i', filename,
+                '-map', '0:a:0', '-af', 'ebur128=peak=true', '-f', 'null', '-']
+
+        try:
+            result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+                                    preexec_fn=_lower_priority if os.name == 'posix' else None)
+        except (OSError, subprocess.CalledProcessError):
+            log.warning("Could not measure the loudness of {}".format(filename), exc_info=True)
+            return
+
+        output = result.stderr.decode('utf8', 'replace')
+        integrated = _ebur128_integrated.findall(output)
+        peak = _ebur128_peak.findall(output)
+
+        if not integrated or not peak:
+            log.warning("Could not find the loudness of {} in ffmpeg's output".format(filename))
+            return
+
+        # The summary comes last, the same labels can show up in the per frame log before it
+        measured = [float(integrated[-1]), float(peak[-1])]
+        log.debug("{} is {} LUFS, peak {} dBFS".format(filename, *measured))
+
+        with self._lock:
+            self._results[os.path.basename(filename)] = measured
+            self._unsaved += 1
+            save = self._unsaved >= self.save_every
+
+        if save:
+            self.save()
+
+    def _load(self):
+        if not self.results_file or not os.path.isfile(self.results_file):
+            return
+
+        try:
+            with open(self.results_file, encoding='utf8') as f:
+                self._results = json.load(f)
+
+        except Exception:
+            log.warning("Could not load loudness measurements from {}".format(self.results_file), exc_info=True)
+
+    def save(self):
+        if not self.results_file:
+            return
+
+        with self._lock:
+            results = dict(self._results)
+            self._unsaved = 0
+
+        try:
+            tmp = self.results_file + '.tmp'
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump(results, f)
+            os.replace(tmp, self.results_file)
+
+        except Exception:
+            log.warning("Could not save loudness measurements to {}".format(self.results_file), exc_info=True)
+
+
+class MediaProbe:
+    """
+        Runs ffprobe once per cached file and remembers what it found: container format, codec, sample rate,
+        channels and duration.  Results are kept in `results_file`.
+
+        The player uses them to tell ffmpeg what it's opening so it can skip most of its own probing, and
+        entries that came without a duration get it filled in.
+    """
+
+    def __init__(self, results_file=None, *, workers=2):
+        self.results_file = results_file
+        self.available = bool(shutil.which('ffprobe'))
+
+        self._results = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        if not self.available:
+            log.warning("ffprobe wasn't found, songs won't be probed ahead of time")
+
+        self._load()
+
+    def get(self, filename):
+        """
+            Returns what's known about `filename` as a dict, or None if it hasn't been probed.
+        """
+
+        return self._results.get(os.path.basename(filename))
+
+    def probe(self, loop, filename):
+        """
+            Probes `filename` in the background unless that's already been done.  Returns a future for the
+            result, which is None if ffprobe couldn't make sense of the file.
+        """
+
+        name = os.path.basename(filename)
+        known = self._results.get(name)
+
+        if known is not None or not self.available:
+            future = asyncio.Future(loop=loop)
+            future.set_result(known)
+            return future
+
+        if name not in self._pending:
+            self._pending[name] = future = loop.run_in_executor(self._executor, self._probe, filename)
+            future.add_done_callback(lambda f: self._pending.pop(name, None))
+
+        return asyncio.shield(self._pending[name])
+
+    def remove(self, filename):
+        with self._lock:
+            self._results.pop(os.path.basename(filename), None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self.save()
+
+    def _probe(self, filename):
+        args = ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+                '-show_entries', 'format=format_name,duration:stream=codec_name,sample_rate,channels',
+                '-of', 'json', filename]
+
+        try:
+            result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+            data = json.loads(result.stdout.decode('utf8'))
+
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            log.warning("Could not probe {}".format(filename), exc_info=True)
+            return None
+
+        fmt = data.get('format') or {}
+        stream = (data.get('streams') or [{}])[0]
+
+        info = {
+            # ffprobe lists every name the demuxer answers to, the first one is what -f wants
+            'format': (fmt.get('format_name') or '').split(',')[0] or None,
+            'codec': stream.get('codec_name'),
+            'sample_rate': int(stream['sample_rate']) if stream.get('sample_rate') else None,
+            'channels': stream.get('channels'),
+            'duration': float(fmt['duration']) if fmt.get('duration') not in (None, 'N/A') else None
+        }
+
+        with self._lock:
+            self._results[os.path.basename(filename)] = info
+
+        return info
+
+    def _load(self):
+        if not self.results_file or not os.path.isfile(self.results_file):
+            return
+
+        try:
+            with open(self.results_file, encoding='utf8') as f:
+                self._results = json.load(f)
+
+        except Exception:
+            log.warning("Could not load probe results from {}".format(self.results_file), exc_info=True)
+
+    def save(self):
+        if not self.results_file:
+            return
+
+        with self._lock:
+            results = dict(self._results)
+
+        try:
+            tmp = self.results_file + '.tmp'
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump(results, f)
+            os.replace(tmp, self.results_file)
+
+        except Exception:
+            log.warning("Could not save probe results to {}".format(self.results_file), exc_info=True)
+
+
+class AudioCacheManager:
+    """
+        Keeps the audio cache folder under a byte budget and a file count budget.  Both are off when 0.
+
+        Every cache hit and every play is recorded, and when a download pushes the folder over budget the
+        coldest files are deleted in the background.  A file gets a day of grace per play (up to
+        `play_grace_limit` days) on top of when it was last used, so songs that keep coming back outlive
+        one-off requests.  Files returned by `protected` (queued and playing songs) are never deleted.
+
+        Finished downloads are filed into `store` so duplicates share their space.  Copies of a file kept by
+        `sidecars` (anything with a `remove(filename)`) are deleted along with it.
+
+        Usage is saved to `stats_file` so it survives restarts.
+    """
+
+    play_grace = 24 * 3600
+    play_grace_limit = 10
+
+    def __init__(self, index, *, store=None, sidecars=(), max_bytes=0, max_files=0, protected=None, stats_file=None):
+        self.index = index
+        self.store = store
+        self.sidecars = list(sidecars)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.protected = protected or (lambda: ())
+        self.stats_file = stats_file
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.files_evicted = 0
+        self.bytes_evicted = 0
+
+        self._usage = {}
+        self._eviction = None
+
+        self._load_usage()
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    @property
+    def over_budget(self):
+        return bool((self.max_bytes and self.index.total_bytes > self.max_bytes) or
+                    (self.max_files and len(self.index) > self.max_files))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio,
+            'bytes_saved': self.bytes_saved,
+            'files': len(self.index),
+            'bytes': self.index.total_bytes,
+            'files_evicted': self.files_evicted,
+            'bytes_evicted': self.bytes_evicted,
+            'objects': len(self.store) if self.store is not None else 0,
+            'bytes_deduplicated': self.store.bytes_deduplicated if self.store is not None else 0
+        }
+
+    def hit(self, filename):
+        """
+            Records that `filename` was found in the cache instead of being downloaded.
+        """
+
+        self.hits += 1
+        self.bytes_saved += self.index.size_of(filename) or 0
+        self.touch(filename)
+
+    def miss(self):
+        self.misses += 1
+
+    def touch(self, filename, *, played=False):
+        usage = self._usage.setdefault(os.path.basename(filename), [0, 0])
+        usage[0] = time.time()
+
+        if played:
+            usage[1] += 1
+
+    async def content_hash(self, loop, filename, hashes=None):
+        """
+            Returns the md5 of a downloaded file.  `hashes` are the ones the downloader worked out while the file
+            was coming in; if there's none for `filename`, or it has changed size since, it's hashed in an executor.
+        """
+
+        size, digest = (hashes or {}).get(os.path.basename(filename)) or (None, None)
+
+        try:
+            if digest and size == os.path.getsize(filename):
+                return digest
+        except OSError:
+            pass
+
+        return await loop.run_in_executor(None, md5sum, filename)
+
+    async def added(self, loop, filename, digest=None):
+        """
+            Records a freshly downloaded file, files it in the content store and starts an eviction if that put
+            the cache over budget.
+        """
+
+        if self.store is not None and digest:
+            await loop.run_in_executor(None, self.store.add, filename, digest)
+
+        self.touch(filename)
+        self.schedule_eviction(loop)
+
+    def removed(self, loop, filename):
+        """
+            Records that `filename` was deleted from the cache by someone else.
+        """
+
+        self.index.discard(filename)
+        self._usage.pop(os.path.basename(filename), None)
+
+        loop.run_in_executor(None, self._release, os.path.basename(filename))
+
+    def _release(self, name):
+        if self.store is not None:
+            self.store.release(name)
+
+        for sidecar in self.sidecars:
+            sidecar.remove(name)
+
+    def schedule_eviction(self, loop):
+        if self.over_budget and (self._eviction is None or self._eviction.done()):
+            self._eviction = asyncio.ensure_future(self._evict(loop), loop=loop)
+
+        return self._eviction
+
+    def coldness(self, name):
+        last_used, plays = self._usage.get(name) or (self.index.mtime_of(name) or 0, 0)
+        return last_used + min(plays, self.play_grace_limit) * self.play_grace
+
+    async def _evict(self, loop):
+        protected = set()
+        for filename in self.protected():
+            if filename:
+                name = os.path.basename(filename)
+                protected.add(name)
+                protected.add(_stem(name))
+
+        total_bytes = self.index.total_bytes
+        total_files = len(self.index)
+        victims = []
+
+        for name in sorted(self.index, key=self.coldness):
+            if (not self.max_bytes or total_bytes <= self.max_bytes) and \
+                    (not self.max_files or total_files <= self.max_files):
+                break
+
+            if name in protected or _stem(name) in protected:
+                continue
+
+            size = self.index.size_of(name) or 0
+            victims.append((name, size))
+            total_bytes -= size
+            total_files -= 1
+
+        if not victims:
+            log.warning("Audio cache is over budget but everything in it is queued")
+            return
+
+        # Take them out of the index first, so nothing picks them up while they're being deleted
+        for name, size in victims:
+            self.index.discard(name)
+            self._usage.pop(name, None)
+
+        deleted = await loop.run_in_executor(None, self._delete, [name for name, _ in victims])
+
+        freed = sum(size for name, size in victims if name in deleted)
+        self.files_evicted += len(deleted)
+        self.bytes_evicted += freed
+
+        log.info("Evicted {} files ({:.1f} MiB) from the audio cache".format(len(deleted), freed / 1024 / 1024))
+        log.debug("Audio cache stats: {}".format(self.stats()))
+
+        await loop.run_in_executor(None, self.save_usage)
+
+    def _delete(self, names):
+        deleted = set()
+
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.index.folder, name))
+                deleted.add(name)
+            except FileNotFoundError:
+                deleted.add(name)
+            except OSError:
+                log.warning("Could not evict {} from the audio cache".format(name), exc_info=True)
+                continue
+
+            self._release(name)
+
+        return deleted
+
+    def _load_usage(self):
+        if not self.stats_file or not os.path.isfile(self.stats_file):
+            return
+
+        try:
+            with open(self.stats_file, encoding='utf8') as f:
+                data = json.load(f)
+
+            self._usage = {name: list(usage) for name, usage in data.get('usage', {}).items()}
+            self.hits = data.get('hits', 0)
+            self.misses = data.get('misses', 0)
+            self.bytes_saved = data.get('bytes_saved', 0)
+
+        except Exception:
+            log.warning("Could not load audio cache stats from {}".format(self.stats_file), exc_info=True)
+
+    def save_usage(self):
+        if self.store is not None:
+            self.store.save()
+
+        if not self.stats_file:
+            return
+
+        data = {
+            'usage': {name: usage for name, usage in self._usage.items() if name in self.index or not self.index.scanned},
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved
+        }
+
+        try:
+            tmp = self.stats_file + '.tmp'
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.stats_file)
+
+        except Exception:
+            log.warning("Could not save audio cache stats to {}".format(self.stats_file), exc_info=True)
+
+
+def _cacheable(name):
+    return not name.startswith('.') and not name.endswith(_partial_suffixes)
+
+
+def _stem(name):
+    return name.rsplit('.', 1)[0]
+
+
+def _prefix(name):
+    return name.rsplit('-', 1)[0]
+
+
+_ebur128_integrated = re.compile(r'I:\s+(-?[\d.]+|-inf) LUFS')
+_ebur128_peak = re.compile(r'Peak:\s+(-?[\d.]+|-inf) dBFS')
+
+
+def _lower_priority():
+    os.nice(10)
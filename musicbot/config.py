@@ -56,6 +56,25 @@ class Config:
         self.delete_invoking = config.getboolean('MusicBot', 'DeleteInvoking', fallback=ConfigDefaults.delete_invoking)
         self.persistent_queue = config.getboolean('MusicBot', 'PersistentQueue', fallback=ConfigDefaults.persistent_queue)
         self.status_message = config.get('MusicBot', 'StatusMessage', fallback=ConfigDefaults.status_message)
+        self.metadata_workers = config.getint('MusicBot', 'MetadataWorkers', fallback=ConfigDefaults.metadata_workers)
+        self.download_workers = config.getint('MusicBot', 'DownloadWorkers', fallback=ConfigDefaults.download_workers)
+        self.extractor_processes = config.getint('MusicBot', 'ExtractorProcesses', fallback=ConfigDefaults.extractor_processes)
+        self.metadata_timeout = config.getfloat('MusicBot', 'MetadataTimeout', fallback=ConfigDefaults.metadata_timeout)
+        self.download_timeout = config.getfloat('MusicBot', 'DownloadTimeout', fallback=ConfigDefaults.download_timeout)
+        self.search_predownload = config.getboolean('MusicBot', 'SearchPredownload', fallback=ConfigDefaults.search_predownload)
+        self.playlist_concurrency = config.getint('MusicBot', 'PlaylistConcurrency', fallback=ConfigDefaults.playlist_concurrency)
+        self.cache_max_size = config.getint('MusicBot', 'CacheMaxSize', fallback=ConfigDefaults.cache_max_size)
+        self.cache_max_files = config.getint('MusicBot', 'CacheMaxFiles', fallback=ConfigDefaults.cache_max_files)
+        self.opus_cache = config.getboolean('MusicBot', 'OpusCache', fallback=ConfigDefaults.opus_cache)
+        self.opus_passthrough = config.getboolean('MusicBot', 'OpusPassthrough', fallback=ConfigDefaults.opus_passthrough)
+        self.normalize_volume = config.getboolean('MusicBot', 'NormalizeVolume', fallback=ConfigDefaults.normalize_volume)
+        self.loudness_target = config.getfloat('MusicBot', 'LoudnessTarget', fallback=ConfigDefaults.loudness_target)
+        self.prefetch_depth = config.getint('MusicBot', 'PrefetchDepth', fallback=ConfigDefaults.prefetch_depth)
+        self.prefetch_max_size = config.getint('MusicBot', 'PrefetchMaxSize', fallback=ConfigDefaults.prefetch_max_size)
+        self.prefetch_max_duration = config.getint('MusicBot', 'PrefetchMaxDuration', fallback=ConfigDefaults.prefetch_max_duration)
+        self.fair_queue = config.getboolean('MusicBot', 'FairQueue', fallback=ConfigDefaults.fair_queue)
+        self.queue_save_delay = config.getfloat('MusicBot', 'QueueSaveDelay', fallback=ConfigDefaults.queue_save_delay)
+        self.queue_save_timeout = config.getfloat('MusicBot', 'QueueSaveTimeout', fallback=ConfigDefaults.queue_save_timeout)
 
         self.debug_level = config.get('MusicBot', 'DebugLevel', fallback=ConfigDefaults.debug_level)
         self.debug_level_str = self.debug_level
@@ -130,6 +149,56 @@ class Config:
 
         self.delete_invoking = self.delete_invoking and self.delete_messages
 
+        if self.metadata_workers < 1:
+            log.warning("MetadataWorkers must be at least 1, using {}".format(ConfigDefaults.metadata_workers))
+            self.metadata_workers = ConfigDefaults.metadata_workers
+
+        if self.download_workers < 1:
+            log.warning("DownloadWorkers must be at least 1, using {}".format(ConfigDefaults.download_workers))
+            self.download_workers = ConfigDefaults.download_workers
+
+        if self.extractor_processes < 0:
+            log.warning("ExtractorProcesses can't be negative, disabling extractor processes")
+            self.extractor_processes = 0
+
+        if self.playlist_concurrency < 1:
+            log.warning("PlaylistConcurrency must be at least 1, using {}".format(ConfigDefaults.playlist_concurrency))
+            self.playlist_concurrency = ConfigDefaults.playlist_concurrency
+
+        if self.cache_max_size < 0 or self.cache_max_files < 0:
+            log.warning("CacheMaxSize and CacheMaxFiles can't be negative, the audio cache won't be limited")
+            self.cache_max_size = max(0, self.cache_max_size)
+            self.cache_max_files = max(0, self.cache_max_files)
+
+        if self.opus_cache and not self.save_videos:
+            log.warning("OpusCache needs SaveVideos to be on, disabling it")
+            self.opus_cache = False
+
+        if self.opus_cache and self.normalize_volume:
+            # Normalized songs are never played at exactly 100%, so the copies would never be used
+            log.warning("OpusCache doesn't work together with NormalizeVolume, disabling it")
+            self.opus_cache = False
+
+        if self.opus_cache and self.default_volume != 1:
+            log.warning("OpusCache is only used at 100% volume, DefaultVolume is {:.0%}".format(self.default_volume))
+
+        if not -40 <= self.loudness_target <= 0:
+            log.warning("LoudnessTarget should be between -40 and 0 LUFS, using {}".format(ConfigDefaults.loudness_target))
+            self.loudness_target = ConfigDefaults.loudness_target
+
+        if self.prefetch_depth < 1:
+            log.warning("PrefetchDepth must be at least 1, using {}".format(ConfigDefaults.prefetch_depth))
+            self.prefetch_depth = ConfigDefaults.prefetch_depth
+
+        self.prefetch_max_size = max(0, self.prefetch_max_size)
+        self.prefetch_max_duration = max(0, self.prefetch_max_duration)
+
+        self.queue_save_delay = max(0, self.queue_save_delay)
+        self.queue_save_timeout = max(0, self.queue_save_timeout)
+
+        self.metadata_timeout = max(0, self.metadata_timeout)
+        self.download_timeout = max(0, self.download_timeout)
+
         self.bound_channels = set(item.replace(',', ' ').strip() for item in self.bound_channels)
 
         self.autojoin_channels = set(item.replace(',', ' ').strip() for item in self.autojoin_channels)
@@ -263,6 +332,25 @@ class ConfigDefaults:
     persistent_queue = True
     debug_level = 'INFO'
     status_message = None
+    metadata_workers = 2
+    download_workers = 2
+    extractor_processes = 0
+    metadata_timeout = 0
+    download_timeout = 900
+    search_predownload = False
+    playlist_concurrency = 4
+    cache_max_size = 0
+    cache_max_files = 0
+    opus_cache = False
+    opus_passthrough = True
+    normalize_volume = False
+    loudness_target = -14
+    prefetch_depth = 1
+    prefetch_max_size = 0
+    prefetch_max_duration = 0
+    fair_queue = False
+    queue_save_delay = 2
+    queue_save_timeout = 10
 
     options_file = 'config/options.ini'
     blacklist_file = 'config/blacklist.txt'
@@ -5,4 +5,9 @@ SUB_VERSION = ''
 VERSION = MAIN_VERSION + SUB_VERSION
 
 AUDIO_CACHE_PATH = os.path.join(os.getcwd(), 'audio_cache')
+INFO_CACHE_PATH = os.path.join(os.getcwd(), 'data', 'info_cache')
+SEARCH_CACHE_PATH = os.path.join(os.getcwd(), 'data', 'search_cache')
+AUDIO_CACHE_STATS_PATH = os.path.join(os.getcwd(), 'data', 'audio_cache_stats.json')
+LOUDNESS_PATH = os.path.join(os.getcwd(), 'data', 'loudness.json')
+PROBE_CACHE_PATH = os.path.join(os.getcwd(), 'data', 'probe_cache.json')
 DISCORD_MSG_CHAR_LIMIT = 2000
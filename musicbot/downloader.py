@@ -1,15 +1,28 @@
 import os
+import json
+import time
+import heapq
+import pickle
 import asyncio
+import hashlib
 import logging
 import functools
+import itertools
+import threading
 import youtube_dl
 #for custom search
 import re
-import urllib.request
 import html
-import json
+import aiohttp
+import urllib.parse
+
+from urllib.parse import urlsplit, urlunsplit
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from concurrent.futures import ThreadPoolExecutor
+from .cache import AudioCacheIndex
+from .exceptions import ExtractionError
 
 log = logging.getLogger(__name__)
 
@@ -30,9 +43,22 @@ ytdl_format_options = {
     'retries': 100
 }
 
+# Job priorities, lower runs first
+PRIORITY_NEXT = 0          # The track the player is waiting on right now
+PRIORITY_INTERACTIVE = 1   # Lookups a user is waiting on
+PRIORITY_PREFETCH = 2      # Prefetching and autoplaylist warming
+PRIORITY_IDLE = 3          # Prefetches that fell out of the lookahead window
+
 # Fuck your useless bugreports message that gets two link embeds and confuses users
 youtube_dl.utils.bug_reports_message = lambda: ''
 
+# The only fields Playlist and the entries ever look at.  Results from worker processes get trimmed down
+# to these so we aren't pickling whole format lists back across the process boundary.
+trimmed_info_fields = (
+    '_type', 'id', 'title', 'duration', 'extractor', 'extractor_key', 'ie_key', 'ext',
+    'url', 'webpage_url', 'is_live', 'description', 'filesize', 'acodec'
+)
+
 '''
     Alright, here's the problem.  To catch youtube-dl errors for their useful information, I have to
     catch the exceptions with `ignoreerrors` off.  To not break when ytdl hits a dumb video
@@ -41,36 +67,502 @@ youtube_dl.utils.bug_reports_message = lambda: ''
 
 '''
 
+
+class TTLCache:
+    """
+        A size bounded LRU with per item expiry, optionally backed by one JSON file per key on disk
+        so it survives restarts.  Keeps hit/miss counters.
+
+        `get` only looks at memory and is meant to be called from the event loop, `load` and `put`
+        touch the disk and should be called from an executor.
+    """
+
+    def __init__(self, cache_folder=None, *, max_size=512):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        if cache_folder and not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / total if total else 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'size': len(self._memory)
+        }
+
+    def get(self, key):
+        """
+            Returns a cached value from memory, or None.
+        """
+        with self._lock:
+            item = self._memory.get(key)
+
+            if item is None:
+                return None
+
+            expires, value = item
+            if expires < time.time():
+                del self._memory[key]
+                return None
+
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def load(self, key):
+        """
+            Returns a cached value from disk, or None.  Disk hits are promoted into memory.
+        """
+        path = self._path_for(key)
+        if not path or not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, encoding='utf8') as f:
+                data = json.load(f)
+
+        except Exception:
+            log.debug("Could not read cached value for {}".format(key), exc_info=True)
+            return None
+
+        if data.get('key') != key or data.get('expires', 0) < time.time():
+            self._unlink(path)
+            return None
+
+        value = self._decode(data['value'])
+        self._remember(key, data['expires'], value)
+
+        with self._lock:
+            self.disk_hits += 1
+
+        return value
+
+    def put(self, key, value, ttl):
+        if ttl <= 0:
+            return
+
+        expires = time.time() + ttl
+        self._remember(key, expires, value)
+
+        path = self._path_for(key)
+        if not path:
+            return
+
+        try:
+            tmp = path + '.tmp'
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump({'key': key, 'expires': expires, 'value': value}, f, default=str)
+            os.replace(tmp, path)
+
+        except Exception:
+            log.debug("Could not write cached value for {}".format(key), exc_info=True)
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def _decode(self, value):
+        return value
+
+    def _remember(self, key, expires, value):
+        with self._lock:
+            self._memory[key] = (expires, value)
+            self._memory.move_to_end(key)
+
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def _path_for(self, key):
+        if self.cache_folder:
+            return os.path.join(self.cache_folder, hashlib.sha1(key.encode('utf8')).hexdigest() + '.json')
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class ExtractionCache(TTLCache):
+    """
+        Caches ytdl info dicts, so that urls we already resolved don't cost another ytdl round trip.
+        Entries expire per extractor, since stream urls go stale long before titles and durations do.
+    """
+
+    # Processed results carry a stream url, these are roughly how long those stay valid
+    stream_ttls = {
+        'youtube': 4 * 3600,
+        'soundcloud': 10 * 60,
+        'bandcamp': 3600,
+        'twitch': 0,
+    }
+
+    def __init__(self, cache_folder=None, *, max_size=512, stream_ttl=30 * 60,
+                 metadata_ttl=7 * 24 * 3600, playlist_ttl=10 * 60):
+        super().__init__(cache_folder, max_size=max_size)
+        self.stream_ttl = stream_ttl
+        self.metadata_ttl = metadata_ttl
+        self.playlist_ttl = playlist_ttl
+
+    @staticmethod
+    def make_key(url, process=True, safe=False):
+        url = url.strip()
+        parts = urlsplit(url)
+
+        if parts.scheme and parts.netloc:
+            # Scheme and host are case insensitive, the fragment never reaches the server
+            url = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+        # The safe ytdl swallows errors, so what it returns can't stand in for what the unsafe one would
+        return '{}{}:{}'.format('p' if process else 'r', 's' if safe else '', url)
+
+    def ttl_for(self, info, process=True):
+        if not info or info.get('is_live'):
+            return 0
+
+        if info.get('_type') == 'playlist' or 'entries' in info:
+            return self.playlist_ttl
+
+        if not process:
+            return self.metadata_ttl
+
+        extractor = (info.get('extractor') or '').lower()
+        return self.stream_ttls.get(extractor.split(':')[0], self.stream_ttl)
+
+    def store(self, key, info, process=True):
+        self.put(key, info, self.ttl_for(info, process))
+
+
+class SearchCache(TTLCache):
+    """
+        Caches scraped search results.  People search for the same handful of artists all day,
+        so queries are normalized before they're used as keys.
+    """
+
+    def __init__(self, cache_folder=None, *, max_size=256, ttl=6 * 3600):
+        super().__init__(cache_folder, max_size=max_size)
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(args, max_results, max_duration):
+        # args arrive quote_plus'd from the search commands
+        query = ' '.join(urllib.parse.unquote_plus(x) for x in args)
+        query = ' '.join(query.casefold().split()).strip('\'"')
+
+        return '{}:{}:{}'.format(max_results, max_duration, query)
+
+    def store(self, key, results):
+        if results:
+            self.put(key, results, self.ttl)
+
+    def _decode(self, value):
+        return [tuple(item) for item in value]
+
+
+# The lane job running on the current worker thread, so ytdl's progress hooks can find it
+_current_job = threading.local()
+
+
+class JobCancelled(ExtractionError):
+    pass
+
+
+class _LaneJob:
+    __slots__ = ['func', 'future', 'priority', 'queued_at', 'started', 'label', 'timer', 'cancel_requested', 'timed_out',
+                 'waiters', 'hashers', 'progress']
+
+    def __init__(self, func, future, priority, label=None):
+        self.func = func
+        self.future = future
+        self.priority = priority
+        self.queued_at = time.monotonic()
+        self.started = False
+        self.label = label
+
+        self.timer = None
+        self.cancel_requested = False
+        self.timed_out = False
+        self.waiters = 0
+        self.hashers = None
+        self.progress = None
+
+
+class _SharedDownload:
+    __slots__ = ['task', 'url', 'waiters']
+
+    def __init__(self, task, url):
+        self.task = task
+        self.url = url
+        self.waiters = 0
+
+
+class _StreamHasher:
+    """
+        md5s a file while ytdl is writing it, by reading whatever was appended since the last progress update.
+        The bytes are still in the page cache at that point, so this is a lot cheaper than reading the whole
+        file back once it's done.
+    """
+
+    __slots__ = ['md5', 'size', '_file']
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self._file = None
+
+    def feed(self, path):
+        if self._file is None:
+            self._file = open(path, 'rb')
+
+        for chunk in iter(lambda: self._file.read(65536), b''):
+            self.md5.update(chunk)
+            self.size += len(chunk)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ExecutorLane:
+    """
+        A thread pool with a priority queue in front of it.  Jobs are only handed to the pool
+        when a worker is free, so a late high priority job doesn't end up behind a pile of
+        prefetches already sitting in the pool's own FIFO queue.
+    """
+
+    def __init__(self, name, max_workers, *, timeout=0, on_timeout=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._running = 0
+
+        self.jobs_started = 0
+        self.jobs_timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        return sum(1 for _, _, job in self._queue if not job.started and not job.future.done())
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def avg_wait(self):
+        return self.total_wait / self.jobs_started if self.jobs_started else 0
+
+    def stats(self):
+        return {
+            'lane': self.name,
+            'queued': self.queue_depth,
+            'running': self._running,
+            'avg_wait': self.avg_wait,
+            'max_wait': self.max_wait,
+            'timed_out': self.jobs_timed_out
+        }
+
+    def submit(self, loop, func, priority=PRIORITY_INTERACTIVE, *, label=None):
+        """
+            Queues `func` to run in the pool.  Returns a job whose `future` fires with the result.
+        """
+        job = _LaneJob(func, asyncio.Future(loop=loop), priority, label)
+        heapq.heappush(self._queue, (priority, next(self._counter), job))
+        self._pump(loop)
+        return job
+
+    def reprioritize(self, loop, job, priority):
+        """
+            Moves a job that hasn't started yet to `priority`, up or down the queue.
+        """
+        if job.started or priority == job.priority:
+            return
+
+        job.priority = priority
+        # The old heap item is skipped once this job has started
+        heapq.heappush(self._queue, (priority, next(self._counter), job))
+        self._pump(loop)
+
+    def _pump(self, loop):
+        while self._running < self.max_workers and self._queue:
+            priority, _, job = heapq.heappop(self._queue)
+
+            # Reprioritized jobs leave their old heap item behind
+            if job.started or job.future.done() or priority != job.priority:
+                continue
+
+            job.started = True
+            self._running += 1
+
+            wait = time.monotonic() - job.queued_at
+            self.jobs_started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            log.noise("Starting {} job after waiting {:.2f}s ({} still queued)".format(self.name, wait, self.queue_depth))
+
+            if self.timeout:
+                job.timer = loop.call_later(self.timeout, self._expire, loop, job)
+
+            efuture = loop.run_in_executor(self.executor, functools.partial(self._run, job))
+            efuture.add_done_callback(functools.partial(self._job_done, loop, job))
+
+    @staticmethod
+    def _run(job):
+        _current_job.job = job
+        try:
+            return job.func()
+        finally:
+            _current_job.job = None
+
+    def _expire(self, loop, job):
+        """
+            Called when a job blows through its deadline.  The caller gets an error right away, and since a
+            thread can't be killed, the stuck one is written off: it's asked to stop at its next progress hook
+            and the lane moves on with a fresh pool so the stuck thread doesn't hold a worker slot.  Only
+            downloads have progress hooks, a stuck lookup keeps its thread busy until ytdl gives up, unless
+            `on_timeout` can stop it some other way (see `Downloader._on_timeout`).
+        """
+        if job.future.done():
+            return
+
+        job.timed_out = True
+        job.cancel_requested = True
+        self.jobs_timed_out += 1
+        self._running -= 1
+
+        log.warning("{} job timed out after {}s: {}".format(self.name.capitalize(), self.timeout, job.label))
+        job.future.set_exception(ExtractionError("Timed out after {} seconds: {}".format(self.timeout, job.label)))
+
+        old_executor, self.executor = self.executor, ThreadPoolExecutor(max_workers=self.max_workers)
+        old_executor.shutdown(wait=False)
+
+        if self.on_timeout:
+            try:
+                self.on_timeout(self, job)
+            except Exception:
+                log.error("Error in timeout handler", exc_info=True)
+
+        self._pump(loop)
+
+    def _job_done(self, loop, job, efuture):
+        if job.timer:
+            job.timer.cancel()
+
+        if job.timed_out:
+            # Already failed and its slot was given back when it expired
+            return
+
+        self._running -= 1
+
+        if not job.future.done():
+            if efuture.cancelled():
+                job.future.cancel()
+            elif efuture.exception() is not None:
+                job.future.set_exception(efuture.exception())
+            else:
+                job.future.set_result(efuture.result())
+
+        self._pump(loop)
+
+
 class Downloader:
-    def __init__(self, download_folder=None):
-        self.thread_pool = ThreadPoolExecutor(max_workers=2)
-        self.unsafe_ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
-        self.safe_ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
-        self.safe_ytdl.params['ignoreerrors'] = True
+    def __init__(self, download_folder=None, info_cache_folder=None, search_cache_folder=None, *,
+                 metadata_workers=2, download_workers=2, extractor_processes=0, metadata_timeout=0, download_timeout=0):
+        self.metadata_lane = ExecutorLane('metadata', metadata_workers, timeout=metadata_timeout, on_timeout=self._on_timeout)
+        self.download_lane = ExecutorLane('download', download_workers, timeout=download_timeout, on_timeout=self._on_timeout)
+        self.timeouts = Counter()
+        self.info_cache = ExtractionCache(info_cache_folder)
+        self.search_cache = SearchCache(search_cache_folder)
+        self._inflight = {}
+        self._downloads = {}
+        self.unsafe_ytdl = make_ytdl(download_folder)
+        self.safe_ytdl = make_ytdl(download_folder, safe=True)
         self.download_folder = download_folder
+        self.cache_index = AudioCacheIndex(download_folder)
+
+        self.process_pool = None
+        self.extractor_processes = extractor_processes
+        if extractor_processes:
+            # Metadata extraction is mostly python crunching json and regexes, which holds the GIL and starves
+            # the voice threads.  The metadata lane's threads hand the actual ytdl work to these processes.
+            self.process_pool = self._make_process_pool()
+
+    def _make_process_pool(self):
+        pool = ProcessPoolExecutor(max_workers=self.extractor_processes)
+
+        for _ in range(self.extractor_processes):
+            pool.submit(_warm_worker, self.download_folder)
+
+        return pool
+
+    def _on_timeout(self, lane, job):
+        extractor = guess_extractor(job.label)
+        self.timeouts[extractor] += 1
+        log.debug("{} timeouts so far for extractor {}".format(self.timeouts[extractor], extractor))
 
-        if download_folder:
-            otmpl = self.unsafe_ytdl.params['outtmpl']
-            self.unsafe_ytdl.params['outtmpl'] = os.path.join(download_folder, otmpl)
-            # print("setting template to " + os.path.join(download_folder, otmpl))
+        if lane is self.metadata_lane and self.process_pool:
+            # Unlike threads, worker processes can actually be killed.  There's no telling which worker has
+            # the stuck job, so the whole pool gets replaced.  Jobs caught in the crossfire are retried.
+            old_pool, self.process_pool = self.process_pool, self._make_process_pool()
 
-            otmpl = self.safe_ytdl.params['outtmpl']
-            self.safe_ytdl.params['outtmpl'] = os.path.join(download_folder, otmpl)
+            for process in list(getattr(old_pool, '_processes', {}).values()):
+                process.terminate()
 
+            old_pool.shutdown(wait=False)
+
+    def shutdown(self):
+        self.metadata_lane.executor.shutdown(wait=False)
+        self.download_lane.executor.shutdown(wait=False)
+
+        if self.process_pool:
+            self.process_pool.shutdown(wait=False)
 
     @property
     def ytdl(self):
         return self.safe_ytdl
 
-    async def extract_info(self, loop, *args, on_error=None, retry_on_error=False, **kwargs):
+    def lane_stats(self):
+        return [self.metadata_lane.stats(), self.download_lane.stats()]
+
+    async def extract_info(self, loop, *args, on_error=None, retry_on_error=False, priority=PRIORITY_INTERACTIVE, **kwargs):
         """
             Runs ytdl.extract_info within the threadpool. Returns a future that will fire when it's done.
             If `on_error` is passed and an exception is raised, the exception will be caught and passed to
             on_error as an argument.
+
+            Downloads and metadata lookups run in separate lanes, `priority` orders jobs within a lane.
         """
         if callable(on_error):
             try:
-                return await loop.run_in_executor(self.thread_pool, functools.partial(self.unsafe_ytdl.extract_info, *args, **kwargs))
+                return await self._extract(loop, self.unsafe_ytdl, *args, priority=priority, **kwargs)
 
             except Exception as e:
 
@@ -86,48 +578,485 @@ class Downloader:
                     loop.call_soon_threadsafe(on_error, e)
 
                 if retry_on_error:
-                    return await self.safe_extract_info(loop, *args, **kwargs)
+                    return await self.safe_extract_info(loop, *args, priority=priority, **kwargs)
         else:
-            return await loop.run_in_executor(self.thread_pool, functools.partial(self.unsafe_ytdl.extract_info, *args, **kwargs))
+            return await self._extract(loop, self.unsafe_ytdl, *args, priority=priority, **kwargs)
+
+    async def safe_extract_info(self, loop, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        return await self._extract(loop, self.safe_ytdl, *args, priority=priority, **kwargs)
+
+    def reprioritize(self, loop, url, priority, *, safe=False, **kwargs):
+        """
+            Moves a queued extract_info job for `url` (called with the same `kwargs`) to `priority`.
+            A job is only moved down if nobody else is waiting on it.
+        """
+        flight_key = self._flight_key(self.safe_ytdl if safe else self.unsafe_ytdl, url, kwargs)
+        job = self._inflight.get(flight_key)
 
-    async def safe_extract_info(self, loop, *args, **kwargs):
-        return await loop.run_in_executor(self.thread_pool, functools.partial(self.safe_ytdl.extract_info, *args, **kwargs))
+        if job and (priority < job.priority or job.waiters <= 1):
+            self._lane_for(kwargs).reprioritize(loop, job, priority)
+
+    def download_progress(self, url, *, safe=False, **kwargs):
+        """
+            Returns how far along the running extract_info job for `url` (called with the same `kwargs`) is, as a
+            dict of `bytes`, `total`, `percent` and `eta` in seconds.  Whatever ytdl doesn't know is None.
+            Returns None if there is no such job or it hasn't started yet.
+        """
+        flight_key = self._flight_key(self.safe_ytdl if safe else self.unsafe_ytdl, url, kwargs)
+        job = self._inflight.get(flight_key)
+
+        if not job or not job.started:
+            return None
+
+        downloaded, total, eta = job.progress or (0, None, None)
+        return {
+            'bytes': downloaded,
+            'total': total,
+            'percent': min(100.0, downloaded * 100 / total) if total else None,
+            'eta': eta
+        }
+
+    def _lane_for(self, kwargs):
+        return self.download_lane if kwargs.get('download', True) else self.metadata_lane
+
+    async def _extract(self, loop, ytdl, url, *, priority=PRIORITY_INTERACTIVE, **kwargs):
+        key = None
+        if not kwargs.get('download', True) and not kwargs.get('ie_key') and not kwargs.get('extra_info'):
+            key = self.info_cache.make_key(url, kwargs.get('process', True), ytdl is self.safe_ytdl)
+
+            info = self.info_cache.get(key)
+            if info is not None:
+                log.debug("Info cache hit: {}".format(url))
+                return info
+
+        lane = self._lane_for(kwargs)
+        func = functools.partial(self._cached_extract, ytdl, key, url, **kwargs)
+
+        flight_key = self._flight_key(ytdl, url, kwargs)
+        if flight_key is None:
+            return await lane.submit(loop, func, priority, label=url).future
+
+        # Everyone asking for the same thing at the same time shares a single ytdl job
+        job = self._inflight.get(flight_key)
+        if job is None:
+            job = lane.submit(loop, func, priority, label=url)
+            job.future.add_done_callback(functools.partial(self._flight_done, flight_key, job))
+            self._inflight[flight_key] = job
+
+        else:
+            log.debug("Joining in-flight extraction: {}".format(url))
+            lane.reprioritize(loop, job, priority)
+
+        # Shielded so that one caller giving up doesn't cancel the job for everyone else
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)
+
+        except asyncio.CancelledError:
+            if job.waiters == 1:
+                self._abandon(job, kwargs)
+            raise
+
+        finally:
+            job.waiters -= 1
+
+    async def download_once(self, loop, filename, url, download):
+        """
+            Runs the coroutine function `download` for whoever asks for `filename` first, everyone else asking for
+            the same file before it's done waits on that instead of downloading and storing it again.  This goes for
+            every server, and for different urls that end up in the same file.  Returns what `download` returns.
+            `url` is what `download` hands to extract_info, see `download_url`.
+
+            The download is cancelled once everyone waiting on it has been cancelled.
+        """
+        key = os.path.normcase(os.path.abspath(filename))
+
+        shared = self._downloads.get(key)
+        if shared is None:
+            shared = _SharedDownload(asyncio.ensure_future(download(), loop=loop), url)
+            shared.task.add_done_callback(functools.partial(self._download_done, key, shared))
+            self._downloads[key] = shared
+
+        else:
+            log.debug("Joining in-progress download of {}".format(filename))
+
+        shared.waiters += 1
+        try:
+            return await asyncio.shield(shared.task)
+
+        except asyncio.CancelledError:
+            if shared.waiters == 1:
+                shared.task.cancel()
+            raise
+
+        finally:
+            shared.waiters -= 1
+
+    def download_url(self, filename):
+        """
+            Returns the url that the shared download of `filename` was started with, which is the one to pass to
+            `reprioritize` and `download_progress`.  Returns None if `filename` isn't being downloaded.
+        """
+        shared = self._downloads.get(os.path.normcase(os.path.abspath(filename)))
+        return shared.url if shared else None
+
+    def _download_done(self, key, shared, task):
+        if self._downloads.get(key) is shared:
+            del self._downloads[key]
+
+    def _abandon(self, job, kwargs):
+        """
+            Called when the last caller waiting on `job` goes away.  Queued jobs are dropped, running downloads
+            are asked to stop.  Running lookups are left alone, their results still end up in the info cache.
+        """
+        if not job.started:
+            job.future.cancel()
+
+        elif kwargs.get('download', True):
+            job.cancel_requested = True
+            job.future.cancel()
+
+    def prefetch_info(self, loop, urls):
+        """
+            Warms the info cache for `urls` at prefetch priority.  Returns one task per url, cancelling a task
+            drops whatever work for that url hasn't started yet.  See `Playlist.predownload` for downloading too.
+        """
+        return [asyncio.ensure_future(self._prefetch(loop, url), loop=loop) for url in urls]
+
+    async def _prefetch(self, loop, url):
+        try:
+            # Same calls, in the same order, as queueing a song makes
+            await self.extract_info(loop, url, download=False, process=False, priority=PRIORITY_PREFETCH)
+            await self.extract_info(loop, url, download=False, priority=PRIORITY_PREFETCH)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            log.debug("Prefetch failed for {}: {}".format(url, e))
+
+    def _flight_key(self, ytdl, url, kwargs):
+        try:
+            flight_key = (ytdl is self.safe_ytdl, url, tuple(sorted(kwargs.items())))
+            hash(flight_key)
+            return flight_key
+        except TypeError:
+            return None
+
+    def _flight_done(self, flight_key, job, future):
+        if self._inflight.get(flight_key) is job:
+            del self._inflight[flight_key]
+
+    def _cached_extract(self, ytdl, key, url, **kwargs):
+        """
+            Runs in the threadpool.  Checks the disk tier before asking ytdl, and stores whatever ytdl returns.
+        """
+        if key is None:
+            info = self._run_ytdl(ytdl, url, **kwargs)
+
+            if info and kwargs.get('download', True):
+                # Hashed on the way in by the progress hook, for whoever ends up storing the file
+                info['_content_hashes'] = _collect_hashes()
+
+            return info
+
+        info = self.info_cache.load(key)
+        if info is not None:
+            return info
+
+        self.info_cache.miss()
+        info = self._run_ytdl(ytdl, url, **kwargs)
+
+        if info and 'entries' in info and not isinstance(info['entries'], list):
+            # Unprocessed playlists hand back a generator, which can't be cached (or iterated twice)
+            info['entries'] = list(info['entries'])
+
+        if info:
+            self.info_cache.store(key, info, kwargs.get('process', True))
+
+        return info
+
+    def _run_ytdl(self, ytdl, url, **kwargs):
+        if self.process_pool and not kwargs.get('download', True):
+            safe = bool(ytdl.params.get('ignoreerrors'))
+
+            try:
+                return self.process_pool.submit(_process_extract, self.download_folder, safe, url, kwargs).result()
+
+            except BrokenProcessPool:
+                job = getattr(_current_job, 'job', None)
+                if job and job.timed_out:
+                    raise
+
+                # Another job timed out and took the pool down with it, this one gets another go
+                log.debug("Extractor pool was recycled, retrying {}".format(url))
+                return self.process_pool.submit(_process_extract, self.download_folder, safe, url, kwargs).result()
+
+        return ytdl.extract_info(url, **kwargs)
 
     ########################
     #  Custom tools
     ########################
-    async def dev_ytbsearch_custom(self, loop, *args, on_error=None, retry_on_error=False, **kwargs):
+    async def dev_ytbsearch_custom(self, loop, *args, session=None, max_results=5, max_duration=5 * 3600,
+                                   fixture=None, **kwargs):
+        """
+            Scrapes youtube's search page for `args`.  Returns a list of (path, title, duration) tuples, or None.
+
+            The page is fetched with aiohttp (`session`, or a throwaway one) and parsed in an executor, so the
+            event loop is never blocked.  Results longer than `max_duration` seconds are skipped.  If `fixture`
+            is a path to a saved results page, that is parsed instead of hitting youtube.
+
+            Results are cached in `search_cache` under the normalized query.
+        """
         # &sp=CAM%253D 는 조회수 기준 정렬
-        ytbsearchprefix="https://www.youtube.com/results?search_query="
-        # 5개씩 searching 강제임니돠
-        val = 5
+        ytbsearchprefix = "https://www.youtube.com/results?search_query="
+
+        if fixture:
+            response_body = await loop.run_in_executor(None, _read_bytes, fixture)
+            return await loop.run_in_executor(
+                None, functools.partial(parse_search_results, response_body, max_results=max_results, max_duration=max_duration))
+
+        key = self.search_cache.make_key(args, max_results, max_duration)
+        results = self.search_cache.get(key)
+
+        if results is None and self.search_cache.cache_folder:
+            results = await loop.run_in_executor(None, self.search_cache.load, key)
+
+        if results is not None:
+            log.debug("Search cache hit: {}".format(key))
+            return results
+
+        self.search_cache.miss()
 
         query = urllib.parse.quote_plus(" ".join(list(urllib.parse.unquote(x) for x in args)))
-        request = urllib.request.Request(ytbsearchprefix + query)
-        response = urllib.request.urlopen(request)
-        rescode = response.getcode()
-        response_body = " "
-        if (rescode == 200):
-            response_body = response.read()
-        else:
-            return None   
-        response_str = str(response_body,"utf-8")
-        if(response_str == " "):
-            return None
-        response_str = html.unescape(response_str)
-        cut1 = 'item-section'
-        cut2 = 'branded-page-box search-pager'
-        response_str = response_str.split(cut1)[2].split(cut2)[0]
-        if(response_str == ''):
+        response_body = await self._fetch_search_page(loop, session, ytbsearchprefix + query)
+
+        if not response_body:
             return None
-        regstr = '(?<=yt-lockup-title ").*?["](.*?)["].*?(?<=title=")(.*?)["].*?(?=<span).*?[>].*?(?<=이: )(.*?)[<]'
-        pattern = re.compile(regstr)
-        it = pattern.finditer(response_str)
-        resultlst = []
-        while len(resultlst) < 5 :
-            tup = it.__next__().groups()
-            splitted = tup[2].split(':')
-            if len(splitted) == 3 and int(splitted[0]) > 5:
-                continue
-            resultlst += [tup]
-        return resultlst
\ No newline at end of file
+
+        results = await loop.run_in_executor(
+            None, functools.partial(parse_search_results, response_body, max_results=max_results, max_duration=max_duration))
+
+        if results:
+            await loop.run_in_executor(None, self.search_cache.store, key, results)
+
+        return results
+
+    async def _fetch_search_page(self, loop, session, url):
+        own_session = session is None
+        if own_session:
+            session = aiohttp.ClientSession(loop=loop)
+
+        try:
+            with aiohttp.Timeout(10):
+                async with session.get(url) as response:
+                    if response.status != 200:
+                        log.warning("Youtube search returned HTTP {}".format(response.status))
+                        return None
+
+                    return await response.read()
+        finally:
+            if own_session:
+                session.close()
+
+
+# The search results page is cut down to the part between these before the result regex runs over it
+_search_section_start = 'item-section'
+_search_section_end = 'branded-page-box search-pager'
+_search_result_pattern = re.compile(
+    '(?<=yt-lockup-title ").*?["](.*?)["].*?(?<=title=")(.*?)["].*?(?=<span).*?[>].*?(?<=이: )(.*?)[<]')
+_search_duration_pattern = re.compile(r'\d+')
+
+
+def parse_search_results(response_body, *, max_results=5, max_duration=5 * 3600):
+    """
+        Pulls (path, title, duration) tuples out of a youtube results page.  Pure and blocking,
+        so it can run in an executor or be timed against a saved page.
+    """
+    if isinstance(response_body, bytes):
+        response_body = str(response_body, "utf-8")
+
+    response_str = html.unescape(response_body)
+
+    try:
+        response_str = response_str.split(_search_section_start)[2].split(_search_section_end)[0]
+    except IndexError:
+        return None
+
+    if not response_str:
+        return None
+
+    resultlst = []
+    for match in _search_result_pattern.finditer(response_str):
+        tup = match.groups()
+
+        if max_duration and _duration_seconds(tup[2]) > max_duration:
+            continue
+
+        resultlst.append(tup)
+        if len(resultlst) >= max_results:
+            break
+
+    return resultlst
+
+
+def _duration_seconds(text):
+    seconds = 0
+    for part in _search_duration_pattern.findall(text):
+        seconds = seconds * 60 + int(part)
+
+    return seconds
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def make_ytdl(download_folder=None, *, safe=False):
+    ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+    ytdl.params['ignoreerrors'] = safe
+    ytdl.add_progress_hook(_progress_hook)
+
+    if download_folder:
+        otmpl = ytdl.params['outtmpl']
+        ytdl.params['outtmpl'] = os.path.join(download_folder, otmpl)
+        # print("setting template to " + os.path.join(download_folder, otmpl))
+
+    return ytdl
+
+
+def _progress_hook(status):
+    job = getattr(_current_job, 'job', None)
+
+    if job and job.cancel_requested:
+        # Raising here is the only way to stop ytdl partway through a download
+        raise JobCancelled("Download cancelled: {}".format(job.label))
+
+    if job:
+        _record_progress(job, status)
+        _hash_progress(job, status)
+
+
+def _record_progress(job, status):
+    if status['status'] == 'downloading':
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        job.progress = (status.get('downloaded_bytes') or 0, total, status.get('eta'))
+
+    elif status['status'] == 'finished':
+        size = status.get('total_bytes') or status.get('downloaded_bytes')
+        job.progress = (size or 0, size, 0)
+
+
+def _hash_progress(job, status):
+    if job.hashers is None:
+        job.hashers = {}
+
+    tmpfilename = status.get('tmpfilename')
+    filename = status.get('filename')
+
+    try:
+        if status['status'] == 'downloading' and tmpfilename:
+            job.hashers.setdefault(tmpfilename, _StreamHasher()).feed(tmpfilename)
+
+        elif status['status'] == 'finished' and filename:
+            hasher = job.hashers.pop(tmpfilename, None) or job.hashers.pop(filename, None) or _StreamHasher()
+            hasher.feed(filename)
+            hasher.close()
+            job.hashers[filename] = hasher
+
+    except OSError:
+        # Whoever stores the file will just have to hash it themselves
+        log.debug("Could not hash {} while downloading".format(filename or tmpfilename), exc_info=True)
+
+        for key in (tmpfilename, filename):
+            hasher = job.hashers.pop(key, None)
+            if hasher:
+                hasher.close()
+
+
+def _collect_hashes():
+    """
+        Returns {file name: [size, md5]} for the files the current job finished downloading.
+    """
+
+    job = getattr(_current_job, 'job', None)
+    if not job or not job.hashers:
+        return {}
+
+    hashes = {}
+    for filename, hasher in job.hashers.items():
+        hasher.close()
+        if hasher.size:
+            hashes[os.path.basename(filename)] = [hasher.size, hasher.md5.hexdigest()]
+
+    job.hashers = None
+    return hashes
+
+
+_extractor_classes = None
+
+def guess_extractor(url):
+    """
+        Returns the key of the extractor ytdl would most likely use for `url`, without touching the network.
+    """
+    global _extractor_classes
+
+    if _extractor_classes is None:
+        _extractor_classes = [ie for ie in youtube_dl.extractor.gen_extractor_classes() if ie.ie_key() != 'Generic']
+
+    for ie in _extractor_classes:
+        try:
+            if ie.suitable(url):
+                return ie.ie_key()
+        except Exception:
+            continue
+
+    return 'Generic'
+
+
+def trim_info(info):
+    """
+        Strips an info dict down to `trimmed_info_fields`, playlists included.
+    """
+    if not info:
+        return info
+
+    trimmed = {k: info[k] for k in trimmed_info_fields if k in info}
+
+    if 'entries' in info:
+        trimmed['entries'] = [trim_info(e) for e in info['entries']]
+
+    return trimmed
+
+
+#############################
+#  Extractor worker processes
+#############################
+
+_worker_ytdls = {}
+
+def _worker_ytdl(download_folder, safe):
+    ytdl = _worker_ytdls.get(safe)
+    if ytdl is None:
+        ytdl = _worker_ytdls[safe] = make_ytdl(download_folder, safe=safe)
+    return ytdl
+
+def _warm_worker(download_folder):
+    # Building a YoutubeDL loads every extractor, get that out of the way before the first real request
+    _worker_ytdl(download_folder, False)
+    _worker_ytdl(download_folder, True)
+
+def _process_extract(download_folder, safe, url, kwargs):
+    try:
+        return trim_info(_worker_ytdl(download_folder, safe).extract_info(url, **kwargs))
+
+    except youtube_dl.utils.DownloadError as e:
+        # exc_info holds a traceback, which can't be pickled back to the bot
+        exc_type, exc_value = (e.exc_info or (None, None, None))[:2]
+        try:
+            pickle.dumps(exc_value)
+        except Exception:
+            exc_value = None
+
+        raise youtube_dl.utils.DownloadError(str(e), (exc_type, exc_value, None))
@@ -1,12 +1,14 @@
 import os
 import asyncio
 import logging
+import functools
 import traceback
 
 from enum import Enum
 from .constructs import Serializable
 from .exceptions import ExtractionError
-from .utils import get_header, md5sum
+from .utils import get_header
+from .downloader import PRIORITY_INTERACTIVE
 
 log = logging.getLogger(__name__)
 
@@ -23,23 +25,37 @@ class EntryTypes(Enum):
 class BasePlaylistEntry(Serializable):
     def __init__(self):
         self.filename = None
-        self._is_downloading = False
+        self._download_task = None
         self._waiting_futures = []
+        self._download_priority = PRIORITY_INTERACTIVE
+
+    @property
+    def is_downloading(self):
+        return self._download_task is not None and not self._download_task.done()
 
     @property
     def is_downloaded(self):
-        if self._is_downloading:
+        if self.is_downloading:
             return False
 
         return bool(self.filename)
 
+    @property
+    def progress(self):
+        """
+        How far along the download is, see `Downloader.download_progress`.  None if nothing is being downloaded.
+        """
+        return None
+
     async def _download(self):
         raise NotImplementedError
 
-    def get_ready_future(self):
+    def get_ready_future(self, priority=PRIORITY_INTERACTIVE):
         """
         Returns a future that will fire when the song is ready to be played. The future will either fire with the result (being the entry) or an exception
-        as to why the song download failed.
+        as to why the song download failed.  It is cancelled if the download is.
+
+        `priority` is where the download goes in the downloader's queue, an entry that is already downloading gets bumped up if needed.
         """
         future = asyncio.Future()
         if self.is_downloaded:
@@ -47,12 +63,43 @@ class BasePlaylistEntry(Serializable):
             future.set_result(self)
 
         else:
-            # If we request a ready future, let's ensure that it'll actually resolve at one point.
-            asyncio.ensure_future(self._download())
             self._waiting_futures.append(future)
 
+            if self.is_downloading:
+                if priority < self._download_priority:
+                    self._download_priority = priority
+                    self._reprioritize(priority)
+            else:
+                # If we request a ready future, let's ensure that it'll actually resolve at one point.
+                # There's only ever one download task per entry, everyone else waits on it.
+                self._download_priority = priority
+                self._download_task = asyncio.ensure_future(self._download())
+
         return future
 
+    def cancel_download(self):
+        """
+        Stops the download if there is one, for entries that aren't going to be played after all.
+        Returns True if there was a download to stop.
+        """
+        if not self.is_downloading:
+            return False
+
+        self._download_task.cancel()
+        self._for_each_future(lambda future: future.cancel())
+        return True
+
+    def set_download_priority(self, priority):
+        """
+        Moves a download that's in progress to `priority`, up or down.  Used when the queue is reordered.
+        """
+        if self.is_downloading and priority != self._download_priority:
+            self._download_priority = priority
+            self._reprioritize(priority)
+
+    def _reprioritize(self, priority):
+        pass
+
     def _for_each_future(self, cb):
         """
             Calls `cb` for each future that is not cancelled. Absorbs and logs any errors that may have occurred.
@@ -139,10 +186,6 @@ class URLPlaylistEntry(BasePlaylistEntry):
 
     # noinspection PyTypeChecker
     async def _download(self):
-        if self._is_downloading:
-            return
-
-        self._is_downloading = True
         try:
             # Ensure the folder that we're going to move into exists.
             if not os.path.exists(self.download_folder):
@@ -151,75 +194,118 @@ class URLPlaylistEntry(BasePlaylistEntry):
             # self.expected_filename: audio_cache\youtube-9R8aSKwTEMg-NOMA_-_Brain_Power.m4a
             extractor = os.path.basename(self.expected_filename).split('-')[0]
 
+            cache_index = self.playlist.downloader.cache_index
+            await cache_index.scan(self.playlist.loop)
+
             # the generic extractor requires special handling
             if extractor == 'generic':
-                flistdir = [f.rsplit('-', 1)[0] for f in os.listdir(self.download_folder)]
                 expected_fname_noex, fname_ex = os.path.basename(self.expected_filename).rsplit('.', 1)
+                lfile = cache_index.find_prefix(expected_fname_noex)
 
-                if expected_fname_noex in flistdir:
+                if lfile:
                     try:
                         rsize = int(await get_header(self.playlist.bot.aiosession, self.url, 'CONTENT-LENGTH'))
+                    except asyncio.CancelledError:
+                        raise
                     except:
                         rsize = 0
 
-                    lfile = os.path.join(
-                        self.download_folder,
-                        os.listdir(self.download_folder)[flistdir.index(expected_fname_noex)]
-                    )
-
                     # print("Resolved %s to %s" % (self.expected_filename, lfile))
-                    lsize = os.path.getsize(lfile)
+                    lsize = cache_index.size_of(lfile)
                     # print("Remote size: %s Local size: %s" % (rsize, lsize))
 
                     if lsize != rsize:
+                        self.playlist.bot.audio_cache.miss()
                         await self._really_download(hash=True)
                     else:
                         # print("[Download] Cached:", self.url)
                         self.filename = lfile
+                        self.playlist.bot.audio_cache.hit(lfile)
 
                 else:
                     # print("File not found in cache (%s)" % expected_fname_noex)
+                    self.playlist.bot.audio_cache.miss()
                     await self._really_download(hash=True)
 
             else:
-                ldir = os.listdir(self.download_folder)
-                flistdir = [f.rsplit('.', 1)[0] for f in ldir]
-                expected_fname_base = os.path.basename(self.expected_filename)
-                expected_fname_noex = expected_fname_base.rsplit('.', 1)[0]
+                lfile = cache_index.find(self.expected_filename)
 
-                # idk wtf this is but its probably legacy code
-                # or i have youtube to blame for changing shit again
+                if not lfile:
+                    self.playlist.bot.audio_cache.miss()
+                    await self._really_download()
 
-                if expected_fname_base in ldir:
-                    self.filename = os.path.join(self.download_folder, expected_fname_base)
+                elif os.path.basename(lfile) == os.path.basename(self.expected_filename):
+                    self.filename = lfile
                     log.info("Download cached: {}".format(self.url))
 
-                elif expected_fname_noex in flistdir:
+                else:
                     log.info("Download cached (different extension): {}".format(self.url))
-                    self.filename = os.path.join(self.download_folder, ldir[flistdir.index(expected_fname_noex)])
+                    self.filename = lfile
                     log.debug("Expected {}, got {}".format(
                         self.expected_filename.rsplit('.', 1)[-1],
                         self.filename.rsplit('.', 1)[-1]
                     ))
-                else:
-                    await self._really_download()
+
+                if lfile:
+                    self.playlist.bot.audio_cache.hit(lfile)
+
+            if self.filename in self.playlist.downloader.cache_index:
+                probe = self.playlist.bot.probes.probe(self.playlist.loop, self.filename)
+
+                # Generic and dropbox links often don't say how long they are, which throws off the queue times
+                if not self.duration:
+                    info = await probe
+                    if info and info['duration']:
+                        self.duration = info['duration']
+                        self.playlist.duration_changed(self)
+                        log.debug("Probed duration of {}: {}".format(self.url, self.duration))
+
+                for worker in (self.playlist.bot.opus_cache, self.playlist.bot.loudness):
+                    if worker:
+                        worker.schedule(self.playlist.loop, self.filename)
 
             # Trigger ready callbacks.
             self._for_each_future(lambda future: future.set_result(self))
 
+        except asyncio.CancelledError:
+            # Cancelling the task cancels the ytdl job too, unless another entry is waiting on the same download
+            log.info("Download cancelled: {}".format(self.url))
+            self._for_each_future(lambda future: future.cancel())
+            raise
+
         except Exception as e:
             traceback.print_exc()
             self._for_each_future(lambda future: future.set_exception(e))
 
-        finally:
-            self._is_downloading = False
+    @property
+    def progress(self):
+        if not self.is_downloading:
+            return None
+
+        return self.playlist.downloader.download_progress(self._download_url, download=True)
+
+    def _reprioritize(self, priority):
+        self.playlist.downloader.reprioritize(self.playlist.loop, self._download_url, priority, download=True)
+
+    @property
+    def _download_url(self):
+        # Joining another entry's download of the same file means its job runs under that entry's url
+        return self.playlist.downloader.download_url(self.expected_filename) or self.url
 
-    # noinspection PyShadowingBuiltins
     async def _really_download(self, *, hash=False):
+        # Entries for the same file, from this server or any other, all wait on the one download
+        self.filename = await self.playlist.downloader.download_once(
+            self.playlist.loop, self.expected_filename, self.url, functools.partial(self._fetch, hash=hash))
+
+    # noinspection PyShadowingBuiltins
+    async def _fetch(self, *, hash=False):
         log.info("Download started: {}".format(self.url))
 
         try:
-            result = await self.playlist.downloader.extract_info(self.playlist.loop, self.url, download=True)
+            result = await self.playlist.downloader.extract_info(
+                self.playlist.loop, self.url, download=True, priority=self._download_priority)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             raise ExtractionError(e)
 
@@ -230,18 +316,30 @@ class URLPlaylistEntry(BasePlaylistEntry):
             raise ExtractionError("ytdl broke and hell if I know why")
             # What the fuck do I do now?
 
-        self.filename = unhashed_fname = self.playlist.downloader.ytdl.prepare_filename(result)
+        # The file is on disk now, so finish storing it even if the download gets cancelled from here on
+        return await asyncio.shield(self._store(result, hash=hash))
+
+    # noinspection PyShadowingBuiltins
+    async def _store(self, result, *, hash=False):
+        filename = unhashed_fname = self.playlist.downloader.ytdl.prepare_filename(result)
+
+        audio_cache = self.playlist.bot.audio_cache
+        digest = await audio_cache.content_hash(self.playlist.loop, unhashed_fname, result.get('_content_hashes'))
 
         if hash:
             # insert the 8 last characters of the file hash to the file name to ensure uniqueness
-            self.filename = md5sum(unhashed_fname, 8).join('-.').join(unhashed_fname.rsplit('.', 1))
+            filename = digest[-8:].join('-.').join(unhashed_fname.rsplit('.', 1))
 
-            if os.path.isfile(self.filename):
+            if os.path.isfile(filename):
                 # Oh bother it was actually there.
                 os.unlink(unhashed_fname)
             else:
                 # Move the temporary file to it's final location.
-                os.rename(unhashed_fname, self.filename)
+                os.rename(unhashed_fname, filename)
+
+        self.playlist.downloader.cache_index.add(filename)
+        await audio_cache.added(self.playlist.loop, filename, digest)
+        return filename
 
 
 class StreamPlaylistEntry(BasePlaylistEntry):
@@ -304,12 +402,13 @@ class StreamPlaylistEntry(BasePlaylistEntry):
 
     # noinspection PyMethodOverriding
     async def _download(self, *, fallback=False):
-        self._is_downloading = True
-
         url = self.destination if fallback else self.url
 
         try:
-            result = await self.playlist.downloader.extract_info(self.playlist.loop, url, download=False)
+            result = await self.playlist.downloader.extract_info(
+                self.playlist.loop, url, download=False, priority=self._download_priority)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             if not fallback and self.destination:
                 return await self._download(fallback=True)
@@ -320,5 +419,3 @@ class StreamPlaylistEntry(BasePlaylistEntry):
             # I might need some sort of events or hooks or shit
             # for when ffmpeg inevitebly fucks up and i have to restart
             # although maybe that should be at a slightly lower level
-        finally:
-            self._is_downloading = False
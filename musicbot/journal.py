@@ -0,0 +1,263 @@
+import os
+import json
+import asyncio
+import logging
+
+from .constructs import Serializer
+
+log = logging.getLogger(__name__)
+
+# A journal smaller than this is never worth compacting, however small the queue is
+_min_compact_bytes = 64 * 1024
+
+
+class QueueJournal:
+    """
+        Keeps a server's queue on disk as a full snapshot of the player followed by a line for every change
+        made to the queue since.  Changes are small appends instead of rewriting the whole queue, so queueing
+        a long playlist costs about as much disk as the playlist itself.
+
+        The first line of the file is the snapshot, the rest are records:
+            {"op": "insert", "index": i, "entries": [...]}   entries put in the queue at position i, with
+                                                             "head": true if they went in front of the queue
+            {"op": "remove", "index": i}                     the entry at position i left the queue
+            {"op": "clear"}                                  the queue was emptied
+            {"op": "current", "entry": ...}                  the entry that's playing now, or null
+
+        Positions are in play order, so `replay` doesn't need to know how the queue orders things.  Changes
+        that aren't a plain insert or removal, like a shuffle, call for a new snapshot instead.
+
+        Snapshots are written behind: asking for one starts a `delay` second timer, and everything asked for
+        until it goes off is covered by the one snapshot.  `snapshot` is called on the event loop to capture
+        the player as plain dicts (see `MusicPlayer.snapshot`), only dumping that and writing it happens in the
+        executor.
+        The new file is written next to the journal, fsynced, and then renamed over it, so a crash leaves
+        either the old file or the new one.  Records made while a snapshot is being written are held back and
+        appended once it's in place.
+    """
+
+    def __init__(self, filename, snapshot, *, loop, delay=0):
+        self.filename = filename
+        self.loop = loop
+        self.delay = delay
+        self._snapshot = snapshot
+
+        self._file = None
+        self._timer = None
+        self._writing = None
+        self._held = []
+        self._stale = False
+        self._closed = False
+
+        self._snapshot_bytes = 0
+        self._journal_bytes = 0
+        self.records = 0
+        self.compactions = 0
+
+    def insert(self, index, entries, *, head=False):
+        record = {'op': 'insert', 'index': index, 'entries': list(entries)}
+        if head:
+            record['head'] = True
+
+        self._append(record)
+
+    def remove(self, index):
+        self._append({'op': 'remove', 'index': index})
+
+    def clear(self):
+        self._append({'op': 'clear'})
+
+    def current(self, entry):
+        self._append({'op': 'current', 'entry': entry})
+
+    def invalidate(self):
+        """
+            For changes that can't be written as records.  Nothing more is recorded until the next snapshot,
+            which is scheduled.
+        """
+        self._stale = True
+        self.schedule()
+
+    def schedule(self):
+        """
+            Asks for a snapshot within `delay` seconds.
+        """
+        if self._timer is None and not self._closed:
+            self._timer = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        """
+            Captures the player now and writes it as a new snapshot.  Returns a future that's done once it's on
+            disk, or once it failed to get there.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        data = self._snapshot()
+
+        # Everything up to now is in the snapshot, and the file is about to be replaced
+        self._stale = False
+        self._held = []
+        self.close_file()
+
+        self._writing = asyncio.ensure_future(self._write(data, self._writing), loop=self.loop)
+        self._writing.add_done_callback(self._written)
+        return self._writing
+
+    def close(self):
+        """
+            Stops recording.  A snapshot that was due is written first, and so is one if there are records held
+            back, since nothing is appended once the journal is closed.  Returns the future of the snapshot
+            that's still being written, or None if the file is already up to date.
+        """
+        if self._timer is not None or self._stale or self._held:
+            self.flush()
+
+        self._closed = True
+        self.close_file()
+        return self._writing
+
+    def close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def _write(self, data, previous):
+        # One snapshot at a time, so an older one never replaces a newer one
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        try:
+            return await self.loop.run_in_executor(None, _write_snapshot, self.filename, data)
+
+        except Exception:
+            log.error("Could not write a snapshot to {}".format(self.filename), exc_info=True)
+
+            # The file is behind now, so there's no point adding to it until a snapshot makes it
+            self._stale = True
+            self.schedule()
+
+    def _written(self, task):
+        if self._writing is not task:
+            # Another snapshot is on its way, whatever is held back goes after that one
+            return
+
+        self._writing = None
+        size = None if task.cancelled() else task.result()
+
+        if size is not None:
+            self._snapshot_bytes = size
+            self._journal_bytes = 0
+            self.records = 0
+            self.compactions += 1
+
+        held, self._held = self._held, []
+        if not self._stale and not self._closed:
+            for line in held:
+                self._write_line(line)
+
+    def _append(self, record):
+        if self._stale or self._closed:
+            return
+
+        line = json.dumps(record, cls=Serializer) + '\n'
+
+        if self._writing is not None:
+            self._held.append(line)
+            return
+
+        if self._file is None and not os.path.isfile(self.filename):
+            # Records only make sense on top of a snapshot
+            return self.invalidate()
+
+        self._write_line(line)
+
+    def _write_line(self, line):
+        if self._file is None:
+            self._file = open(self.filename, 'a', encoding='utf8')
+
+        self._file.write(line)
+        self._file.flush()
+
+        self.records += 1
+        self._journal_bytes += len(line)
+
+        if self._journal_bytes > max(self._snapshot_bytes, _min_compact_bytes):
+            log.debug("Compacting {} ({} records)".format(self.filename, self.records))
+            self.schedule()
+
+    @staticmethod
+    def replay(filename):
+        """
+            Applies the records in `filename` to its snapshot and returns the player json that results, for
+            `MusicPlayer.from_json`.  Returns None if there's no usable snapshot.
+        """
+        with open(filename, 'r', encoding='utf8') as f:
+            lines = f.read().splitlines()
+
+        try:
+            player = json.loads(lines[0])['data']
+        except (IndexError, ValueError, KeyError):
+            log.warning("No usable snapshot in {}".format(filename))
+            return None
+
+        state = player['data']
+        playlist = state['entries']['data']
+        queue = playlist['entries']
+        front = playlist.get('front', 0)
+        records = 0
+
+        for number, line in enumerate(lines[1:], 2):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Most likely the last line, cut short by a crash
+                log.warning("Stopped replaying {} at line {}, it's damaged".format(filename, number))
+                break
+
+            op = record.get('op')
+            if op == 'insert':
+                index = record['index']
+                queue[index:index] = record['entries']
+                if record.get('head'):
+                    front += len(record['entries'])
+            elif op == 'remove':
+                if 0 <= record['index'] < len(queue):
+                    del queue[record['index']]
+                    if record['index'] < front:
+                        front -= 1
+            elif op == 'clear':
+                del queue[:]
+                front = 0
+            elif op == 'current':
+                state['current_entry'] = {'entry': record['entry'], 'progress': None, 'progress_frames': None}
+
+            records += 1
+
+        playlist['front'] = front
+        log.debug("Replayed {} records on top of the snapshot in {}".format(records, filename))
+        return json.dumps(player)
+
+
+def _write_snapshot(filename, data):
+    """
+        Runs in the executor.  Writes `data` as the only line of a new journal and swaps it in, returns its size.
+    """
+    line = '{{"op": "snapshot", "data": {}}}\n'.format(json.dumps(data, sort_keys=True))
+    write_atomic(filename, line)
+    return len(line)
+
+
+def write_atomic(filename, text):
+    """
+        Replaces `filename` with `text` so that a crash partway through leaves the old file as it was.
+    """
+    tmp = filename + '.tmp'
+
+    with open(tmp, 'w', encoding='utf8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp, filename)
@@ -0,0 +1,560 @@
+import random
+import itertools
+import collections
+
+
+class IndexedQueue:
+    """
+        A deque of items that also knows, without walking the whole thing, how long the queue is up to any
+        position, how many items each group has, and where any item currently is.
+
+        Items sit in a slot array with room on both ends, so appending at either end never moves the others.
+        Two Fenwick trees over the slots count the items and add up their `weight`, which makes indexing,
+        removal and prefix sums O(log n).  Every item gets an id when it's added that stays the same until it
+        leaves the queue, however much gets added or removed in front of it.
+
+        `weight` and `group` are called with an item when it's added.  Call `update` when an item's weight
+        changes while it's queued.
+    """
+
+    def __init__(self, items=(), *, weight=None, group=None):
+        self._weight = weight or (lambda item: 0)
+        self._group = group or (lambda item: None)
+        self._ids = itertools.count(1)
+
+        self._slot_of = {}   # id -> slot
+        self._id_of = {}     # item -> id
+        self._groups = collections.Counter()
+        self._build([])
+
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self._id_of)
+
+    def __bool__(self):
+        return bool(self._id_of)
+
+    def __iter__(self):
+        # Not a copy, so that islice over the front of a long queue stays cheap
+        slots = self._slots
+        for slot in range(self._first, self._end):
+            cell = slots[slot]
+            if cell is not None:
+                yield cell[1]
+
+    def __contains__(self, item):
+        return item in self._id_of
+
+    def __getitem__(self, index):
+        return self._slots[self._slot_at(index)][1]
+
+    def append(self, item):
+        """
+            Adds `item` to the end of the queue, returns its id.
+        """
+        if self._end == len(self._slots):
+            self._build(list(self._cells()))
+
+        slot = self._end
+        self._end += 1
+        return self._place(slot, item)
+
+    def appendleft(self, item):
+        """
+            Adds `item` to the front of the queue, returns its id.
+        """
+        if self._first == 0:
+            self._build(list(self._cells()))
+
+        self._first -= 1
+        return self._place(self._first, item)
+
+    def extendleft(self, items):
+        """
+            Adds `items` to the front of the queue, keeping their order (unlike `deque.extendleft`).
+        """
+        items = list(items)
+        if self._first < len(items):
+            self._build(list(self._cells()), room=len(items))
+
+        for item in reversed(items):
+            self._first -= 1
+            self._place(self._first, item)
+
+    def popleft(self):
+        if not self:
+            raise IndexError("pop from an empty queue")
+
+        slot = self._slot_at(0)
+        self._first = slot + 1
+        return self._take(slot)
+
+    def pop(self):
+        if not self:
+            raise IndexError("pop from an empty queue")
+
+        slot = self._slot_at(-1)
+        self._end = slot
+        return self._take(slot)
+
+    def remove(self, item):
+        """
+            Takes `item` out of the queue, wherever it is.
+        """
+        try:
+            slot = self._slot_of[self._id_of[item]]
+        except KeyError:
+            raise ValueError("item is not queued") from None
+
+        self._take(slot)
+
+    def clear(self):
+        self._slot_of.clear()
+        self._id_of.clear()
+        self._groups.clear()
+        self._build([])
+
+    def shuffle(self):
+        cells = list(self._cells())
+        random.shuffle(cells)
+        self._build(cells)
+
+    def id_of(self, item):
+        """
+            Returns the id `item` got when it was queued, or None if it isn't queued.
+        """
+        return self._id_of.get(item)
+
+    def get(self, item_id):
+        """
+            Returns the queued item with id `item_id`, or None.
+        """
+        slot = self._slot_of.get(item_id)
+        if slot is not None:
+            return self._slots[slot][1]
+
+    def index(self, item):
+        """
+            Returns where `item` is in the queue, counting from 0.
+        """
+        try:
+            slot = self._slot_of[self._id_of[item]]
+        except KeyError:
+            raise ValueError("item is not queued") from None
+
+        return self._prefix(self._counts, slot)
+
+    def weight_before(self, index):
+        """
+            Returns the total weight of the first `index` items.
+        """
+        if index <= 0:
+            return 0
+
+        if index >= len(self):
+            return self._prefix(self._weights, len(self._slots))
+
+        return self._prefix(self._weights, self._slot_at(index))
+
+    @property
+    def total_weight(self):
+        return self.weight_before(len(self))
+
+    def count(self, group):
+        """
+            Returns how many queued items are in `group`.
+        """
+        return self._groups[group]
+
+    def front_length(self):
+        """
+            Returns how many items at the head have to be put back with `extendleft` to rebuild the queue in the
+            same order.  Appending keeps every item's place here, so there are none.
+        """
+        return 0
+
+    def update(self, item):
+        """
+            Picks up a change in `item`'s weight.  Does nothing if `item` isn't queued.
+        """
+        item_id = self._id_of.get(item)
+        if item_id is None:
+            return
+
+        slot = self._slot_of[item_id]
+        weight = self._weight(item)
+        self._add(self._weights, slot, weight - self._slot_weights[slot])
+        self._slot_weights[slot] = weight
+
+    def _cells(self):
+        slots = self._slots
+        for slot in range(self._first, self._end):
+            if slots[slot] is not None:
+                yield slots[slot]
+
+    def _build(self, cells, room=0):
+        """
+            Lays `cells` out in a fresh slot array, centered so both ends have space to grow.
+        """
+        size = 16
+        while size < 4 * (len(cells) + room):
+            size *= 2
+
+        self._slots = [None] * size
+        self._slot_weights = [0] * size
+        self._counts = [0] * (size + 1)
+        self._weights = [0] * (size + 1)
+        self._first = self._end = (size - len(cells)) // 2
+
+        for item_id, item in cells:
+            slot = self._end
+            self._end += 1
+            self._slots[slot] = (item_id, item)
+            self._slot_weights[slot] = self._weight(item)
+            self._slot_of[item_id] = slot
+
+        # Linear time Fenwick tree construction
+        for tree, values in ((self._counts, [cell is not None for cell in self._slots]), (self._weights, self._slot_weights)):
+            for i, value in enumerate(values, 1):
+                tree[i] += value
+                parent = i + (i & -i)
+                if parent <= size:
+                    tree[parent] += tree[i]
+
+    def _place(self, slot, item):
+        if item in self._id_of:
+            raise ValueError("item is already queued")
+
+        item_id = next(self._ids)
+        weight = self._weight(item)
+
+        self._slots[slot] = (item_id, item)
+        self._slot_weights[slot] = weight
+        self._slot_of[item_id] = slot
+        self._id_of[item] = item_id
+        self._groups[self._group(item)] += 1
+
+        self._add(self._counts, slot, 1)
+        self._add(self._weights, slot, weight)
+        return item_id
+
+    def _take(self, slot):
+        item_id, item = self._slots[slot]
+
+        self._add(self._counts, slot, -1)
+        self._add(self._weights, slot, -self._slot_weights[slot])
+        self._slots[slot] = None
+        self._slot_weights[slot] = 0
+
+        del self._slot_of[item_id]
+        del self._id_of[item]
+
+        group = self._group(item)
+        self._groups[group] -= 1
+        if not self._groups[group]:
+            del self._groups[group]
+
+        if not self._id_of:
+            # Start over in the middle rather than creeping towards one end
+            self._build([])
+
+        return item
+
+    def _slot_at(self, index):
+        """
+            Returns the slot of the item at `index`, found by walking down the count tree.
+        """
+        length = len(self)
+        if index < 0:
+            index += length
+
+        if not 0 <= index < length:
+            raise IndexError("queue index out of range")
+
+        tree = self._counts
+        slot = 0
+        step = len(self._slots)
+
+        while step:
+            if slot + step < len(tree) and tree[slot + step] <= index:
+                slot += step
+                index -= tree[slot]
+            step //= 2
+
+        return slot
+
+    @staticmethod
+    def _add(tree, slot, delta):
+        i = slot + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    @staticmethod
+    def _prefix(tree, slot):
+        """
+            Returns the sum over the slots before `slot`.
+        """
+        total = 0
+        i = slot
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+
+        return total
+
+
+class FairQueue:
+    """
+        An IndexedQueue look-alike that takes turns between groups instead of going first come, first served.
+        Every group gets its own IndexedQueue, and the groups with something queued sit in a ring.  Each pick
+        takes the next item of the group at the front of the ring, then moves that group to the back.
+        A group that wasn't queued joins at the back of the ring.
+
+        Items added to the front (`appendleft`, `extendleft`) skip the rotation and are played first.
+
+        Iterating, indexing and `weight_before` all follow the order items will be picked in.
+    """
+
+    def __init__(self, items=(), *, weight=None, group=None):
+        self._weight = weight or (lambda item: 0)
+        self._group = group or (lambda item: None)
+        self._ids = itertools.count(1)
+
+        self._front = IndexedQueue(weight=self._weight, group=self._group)
+        self._queues = {}
+        self._ring = collections.deque()
+        self._home = {}      # item -> the IndexedQueue it's in
+        self._id_of = {}
+        self._by_id = {}
+
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self._home)
+
+    def __bool__(self):
+        return bool(self._home)
+
+    def __iter__(self):
+        yield from self._front
+
+        # One from every group per round, in ring order, dropping groups as they run out
+        iterators = collections.deque(iter(self._queues[group]) for group in self._ring)
+        while iterators:
+            iterator = iterators.popleft()
+            for item in iterator:
+                yield item
+                iterators.append(iterator)
+                break
+
+    def __contains__(self, item):
+        return item in self._home
+
+    def __getitem__(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+
+        if not 0 <= index < length:
+            raise IndexError("queue index out of range")
+
+        if index < len(self._front):
+            return self._front[index]
+
+        if index == len(self._front):
+            return self._queues[self._ring[0]][0]
+
+        return next(itertools.islice(self, index, None))
+
+    def append(self, item):
+        """
+            Adds `item` to the end of its group's queue, returns its id.
+        """
+        group = self._group(item)
+
+        queue = self._queues.get(group)
+        if queue is None:
+            queue = self._queues[group] = IndexedQueue(weight=self._weight, group=self._group)
+            self._ring.append(group)
+
+        queue.append(item)
+        return self._register(item, queue)
+
+    def appendleft(self, item):
+        """
+            Adds `item` in front of everything, returns its id.
+        """
+        self._front.appendleft(item)
+        return self._register(item, self._front)
+
+    def extendleft(self, items):
+        """
+            Adds `items` in front of everything, keeping their order.
+        """
+        items = list(items)
+        self._front.extendleft(items)
+
+        for item in items:
+            self._register(item, self._front)
+
+    def popleft(self):
+        if self._front:
+            return self._unregister(self._front.popleft())
+
+        if not self._ring:
+            raise IndexError("pop from an empty queue")
+
+        group = self._ring.popleft()
+        queue = self._queues[group]
+        item = queue.popleft()
+
+        if queue:
+            self._ring.append(group)
+        else:
+            del self._queues[group]
+
+        return self._unregister(item)
+
+    def pop(self):
+        item = self[-1]
+        self.remove(item)
+        return item
+
+    def remove(self, item):
+        """
+            Takes `item` out of the queue, wherever it is.
+        """
+        queue = self._home.get(item)
+        if queue is None:
+            raise ValueError("item is not queued")
+
+        queue.remove(item)
+        self._unregister(item)
+
+        if queue is not self._front and not queue:
+            group = self._group(item)
+            del self._queues[group]
+            self._ring.remove(group)
+
+    def clear(self):
+        self._front.clear()
+        self._queues.clear()
+        self._ring.clear()
+        self._home.clear()
+        self._id_of.clear()
+        self._by_id.clear()
+
+    def shuffle(self):
+        self._front.shuffle()
+        for queue in self._queues.values():
+            queue.shuffle()
+
+        random.shuffle(self._ring)
+
+    def id_of(self, item):
+        return self._id_of.get(item)
+
+    def get(self, item_id):
+        return self._by_id.get(item_id)
+
+    def index(self, item):
+        """
+            Returns where `item` is in the order items will be picked in, counting from 0.
+        """
+        queue = self._home.get(item)
+        if queue is None:
+            raise ValueError("item is not queued")
+
+        if queue is self._front:
+            return queue.index(item)
+
+        # Everyone gets one turn per round, so this is the item's round plus whoever goes before it in that round
+        position = queue.index(item)
+        group = self._group(item)
+        index = len(self._front)
+
+        before = True
+        for other in self._ring:
+            if other == group:
+                before = False
+                index += position
+            else:
+                index += min(len(self._queues[other]), position + before)
+
+        return index
+
+    def weight_before(self, index):
+        """
+            Returns the total weight of the first `index` items, in the order they will be picked in.
+        """
+        if index <= 0:
+            return 0
+
+        front = len(self._front)
+        if index <= front:
+            return self._front.weight_before(index)
+
+        total = self._front.total_weight
+        index -= front
+
+        if index >= len(self) - front:
+            return total + sum(queue.total_weight for queue in self._queues.values())
+
+        lengths = [len(self._queues[group]) for group in self._ring]
+
+        # Find the last round that is picked in full: the number of picks in r rounds only grows with r
+        low, high = 0, max(lengths)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if sum(min(length, middle) for length in lengths) <= index:
+                low = middle
+            else:
+                high = middle - 1
+
+        rounds = low
+        index -= sum(min(length, rounds) for length in lengths)
+
+        for group, length in zip(self._ring, lengths):
+            queue = self._queues[group]
+            taken = min(length, rounds)
+
+            # Then whoever's turn comes up in the round that's only partly picked
+            if index and length > rounds:
+                taken += 1
+                index -= 1
+
+            total += queue.weight_before(taken)
+
+        return total
+
+    @property
+    def total_weight(self):
+        return self.weight_before(len(self))
+
+    def count(self, group):
+        queue = self._queues.get(group)
+        return self._front.count(group) + (len(queue) if queue else 0)
+
+    def front_length(self):
+        return len(self._front)
+
+    def update(self, item):
+        queue = self._home.get(item)
+        if queue is not None:
+            queue.update(item)
+
+    def _register(self, item, queue):
+        item_id = next(self._ids)
+        self._home[item] = queue
+        self._id_of[item] = item_id
+        self._by_id[item_id] = item
+        return item_id
+
+    def _unregister(self, item):
+        del self._home[item]
+        del self._by_id[self._id_of.pop(item)]
+        return item
@@ -0,0 +1,162 @@
+import mmap
+import struct
+
+_page_header = struct.Struct('<4sBBqIIIB')
+
+# Frame length in ms for each opus TOC config, see RFC 6716 section 3.1
+_silk_frames = (10, 20, 40, 60)
+_hybrid_frames = (10, 20)
+_celt_frames = (2.5, 5, 10, 20)
+
+
+class OggError(Exception):
+    pass
+
+
+class OggOpusReader:
+    """
+        Reads the opus packets out of an Ogg/Opus stream, one per `read_packet` call.  `source` is either the
+        path of a file, which is read through a memory map, or a binary file object such as a pipe.
+        The OpusHead and OpusTags header packets are skipped.
+
+        Has the `frame_count` and `volume` attributes of a PatchedBuff so the player can treat it like one.
+    """
+
+    def __init__(self, source, *, name=None):
+        self.filename = name or source
+        self.frame_count = 0
+        self.volume = 1.0
+
+        self._file = None
+        self._map = None
+        self._stream = None
+        self._offset = 0
+
+        if isinstance(source, str):
+            self._file = open(source, 'rb')
+            try:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except Exception:
+                self._file.close()
+                raise
+        else:
+            self._stream = source
+
+        self._pending = []
+        self._partial = b''
+
+        try:
+            head = self._next_packet()
+            if not head.startswith(b'OpusHead'):
+                raise OggError("{} is not an Ogg/Opus stream".format(self.filename))
+
+            self._next_packet()  # OpusTags
+
+        except Exception:
+            self.close()
+            raise
+
+    def peek_packet(self):
+        """
+            Returns the next opus packet without consuming it, or b'' at the end of the stream.
+        """
+
+        packet = self._next_packet()
+        if packet:
+            self._pending.insert(0, packet)
+
+        return packet
+
+    def read_packet(self):
+        """
+            Returns the next opus packet, or b'' at the end of the stream.
+        """
+
+        packet = self._next_packet()
+        if packet:
+            self.frame_count += 1
+
+        return packet
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        if self._stream is not None:
+            self._stream.close()
+
+    def _read(self, size):
+        if self._stream is not None:
+            return self._stream.read(size)
+
+        if self._map is None:
+            return b''
+
+        data = self._map[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def _next_packet(self):
+        while not self._pending:
+            if not self._read_page():
+                return b''
+
+        return self._pending.pop(0)
+
+    def _read_page(self):
+        header = self._read(_page_header.size)
+        if len(header) < _page_header.size:
+            return False
+
+        capture, version, header_type, granule, serial, sequence, checksum, segments = _page_header.unpack(header)
+
+        if capture != b'OggS':
+            raise OggError("Lost sync in {}".format(self.filename))
+
+        lacing = self._read(segments)
+        body = self._read(sum(lacing))
+        position = 0
+
+        packet = self._partial
+        for size in lacing:
+            packet += body[position:position + size]
+            position += size
+
+            # A lacing value under 255 ends the packet, 255 means it continues in the next segment
+            if size < 255:
+                self._pending.append(packet)
+                packet = b''
+
+        self._partial = packet
+        return True
+
+
+def packet_duration(packet):
+    """
+        Returns how many milliseconds of audio an opus packet holds, from its TOC byte.
+    """
+
+    toc = packet[0]
+    config = toc >> 3
+
+    if config < 12:
+        frame = _silk_frames[config % 4]
+    elif config < 16:
+        frame = _hybrid_frames[config % 2]
+    else:
+        frame = _celt_frames[config % 4]
+
+    code = toc & 3
+    if code == 0:
+        frames = 1
+    elif code < 3:
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F
+
+    return frame * frames
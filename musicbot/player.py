@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import time
 import logging
 import asyncio
 import audioop
@@ -12,14 +13,19 @@ from threading import Thread
 from collections import deque
 from shutil import get_terminal_size
 from websockets.exceptions import InvalidState
+from discord.voice_client import StreamPlayer
 
 from .utils import avg, _func_
+from .lib.ogg import OggOpusReader, packet_duration
 from .lib.event_emitter import EventEmitter
 from .constructs import Serializable, Serializer
 from .exceptions import FFmpegError, FFmpegWarning
 
 log = logging.getLogger(__name__)
 
+# Containers ytdl hands us that usually hold opus
+_opus_containers = ('.webm', '.opus', '.ogg', '.mka')
+
 
 class PatchedBuff:
     """
@@ -82,6 +88,52 @@ class PatchedBuff:
         print(outstr.ljust(tx - 1), end='\r')
 
 
+class OpusPacketPlayer(StreamPlayer):
+    """
+        Plays pre-encoded opus packets from `packets` (an OggOpusReader), handing them to discord as they are.
+        No decoding and no encoding, but also no volume control, so it's only used at 100% volume.
+        If the packets come from a `process`, it's killed when playback ends.
+    """
+
+    def __init__(self, packets, voice_client, *, process=None, after=None):
+        super().__init__(packets, voice_client.encoder, voice_client._connected, voice_client.play_audio, after)
+        self.process = process
+
+    def _do_run(self):
+        self.loops = 0
+        self._start = time.time()
+
+        while not self._end.is_set():
+            # are we paused?
+            if not self._resumed.is_set():
+                self._resumed.wait()
+
+            if not self._connected.is_set():
+                self.stop()
+                break
+
+            packet = self.buff.read_packet()
+            if not packet:
+                self.stop()
+                break
+
+            self.loops += 1
+            self.player(packet, encode=False)
+
+            next_time = self._start + self.delay * self.loops
+            time.sleep(max(0, self.delay + (next_time - time.time())))
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.buff.close()
+
+            if self.process:
+                self.process.kill()
+                self.process.wait()
+
+
 class MusicPlayerState(Enum):
     STOPPED = 0  # When the player isn't playing anything
     PLAYING = 1  # The player is actively playing music.
@@ -104,12 +156,14 @@ class MusicPlayer(EventEmitter, Serializable):
         self.skip_state = None
 
         self._volume = bot.config.default_volume
+        self._gain = 1.0
         self._play_lock = asyncio.Lock()
         self._current_player = None
         self._current_entry = None
         self._stderr_future = None
 
         self.playlist.on('entry-added', self.on_entry_added)
+        self.playlist.on('entries-added', self.on_entries_added)
         self.loop.create_task(self.websocket_check())
 
     @property
@@ -119,8 +173,17 @@ class MusicPlayer(EventEmitter, Serializable):
     @volume.setter
     def volume(self, value):
         self._volume = value
-        if self._current_player:
-            self._current_player.buff.volume = value
+
+        if isinstance(self._current_player, OpusPacketPlayer) and value * self._gain != 1:
+            # Packets can't be made quieter, pick the song back up through ffmpeg from where it is now
+            log.debug("Volume changed, switching {} to ffmpeg".format(self._current_entry.filename))
+            packet_player = self._current_player
+            packet_player.after = None
+            packet_player.stop()
+            self._start_player(self._current_entry, start_frame=packet_player.buff.frame_count)
+
+        elif self._current_player:
+            self._current_player.buff.volume = value * self._gain
 
     def on_entry_added(self, playlist, entry):
         if self.is_stopped:
@@ -128,8 +191,16 @@ class MusicPlayer(EventEmitter, Serializable):
 
         self.emit('entry-added', player=self, playlist=playlist, entry=entry)
 
+    def on_entries_added(self, playlist, entries):
+        if self.is_stopped:
+            self.loop.call_later(2, self.play)
+
+        self.emit('entries-added', player=self, playlist=playlist, entries=entries)
+
     def skip(self):
-        self._kill_current_player()
+        if not self._kill_current_player():
+            # Still waiting on the next song's download, skip that one instead
+            self.playlist.skip_loading()
 
     def stop(self):
         self.state = MusicPlayerState.STOPPED
@@ -167,10 +238,22 @@ class MusicPlayer(EventEmitter, Serializable):
         raise ValueError('Cannot pause a MusicPlayer in state %s' % self.state)
 
     def kill(self):
+        """
+            Stops the player for good.  Returns the future of the queue's last snapshot if it's still being
+            written, see `QueueJournal.close`.
+        """
         self.state = MusicPlayerState.DEAD
+        saving = None
+
+        if self.playlist.journal is not None:
+            # What's queued now should still be there when the bot comes back
+            saving = self.playlist.journal.close()
+            self.playlist.journal = None
+
         self.playlist.clear()
         self._events.clear()
         self._kill_current_player()
+        return saving
 
     def _playback_finished(self):
         entry = self._current_entry
@@ -217,6 +300,7 @@ class MusicPlayer(EventEmitter, Serializable):
         for x in range(30):
             try:
                 os.unlink(filename)
+                self.bot.audio_cache.removed(self.loop, filename)
                 break
 
             except PermissionError as e:
@@ -258,41 +342,112 @@ class MusicPlayer(EventEmitter, Serializable):
                     self.stop()
                     return
 
+                packets, process = await self._open_packets(entry)
+
                 # In-case there was a player, kill it. RIP.
                 self._kill_current_player()
 
-                boptions = "-nostdin"
-                # aoptions = "-vn -b:a 192k"
-                aoptions = "-vn"
-
-                log.ffmpeg("Creating player with options: {} {} {}".format(boptions, aoptions, entry.filename))
-
-                self._current_player = self._monkeypatch_player(self.voice_client.create_ffmpeg_player(
-                    entry.filename,
-                    before_options=boptions,
-                    options=aoptions,
-                    stderr=subprocess.PIPE,
-                    # Threadsafe call soon, b/c after will be called from the voice playback thread.
-                    after=lambda: self.loop.call_soon_threadsafe(self._playback_finished)
-                ))
-                self._current_player.setDaemon(True)
-                self._current_player.buff.volume = self.volume
-
                 # I need to add ytdl hooks
                 self.state = MusicPlayerState.PLAYING
                 self._current_entry = entry
-                self._stderr_future = asyncio.Future()
+                self._start_player(entry, packets=packets, process=process)
+
+                self.emit('play', player=self, entry=entry)
 
-                stderr_thread = Thread(
-                    target=filter_stderr,
-                    args=(self._current_player.process, self._stderr_future),
-                    name="{} stderr reader".format(self._current_player.name)
-                )
+    async def _open_packets(self, entry):
+        """
+            Returns (packets, process) to play `entry` from without decoding it, or (None, None) if it has to go
+            through ffmpeg's pcm output.  That's when the volume (including loudness normalization) isn't 100%,
+            or there's no opus to pass through.
 
-                stderr_thread.start()
-                self._current_player.start()
+            The opus cache copy is used if there is one.  Otherwise a song that's already opus is remuxed by
+            ffmpeg (`-c:a copy`, no decoding) into an ogg stream, and the packets are read from its stdout.
+        """
 
-                self.emit('play', player=self, entry=entry)
+        if self.volume * self._gain_for(entry) != 1:
+            return None, None
+
+        if self.bot.opus_cache:
+            packets = self.bot.opus_cache.open(entry.filename)
+            if packets:
+                return packets, None
+
+        probe = self.bot.probes.get(entry.filename)
+        if probe:
+            is_opus = probe['codec'] == 'opus'
+        else:
+            is_opus = entry.filename.lower().endswith(_opus_containers) and os.path.isfile(entry.filename)
+
+        if self.bot.config.opus_passthrough and is_opus:
+            return await self.loop.run_in_executor(
+                None, open_opus_passthrough, entry.filename, _input_hints(probe))
+
+        return None, None
+
+    def _gain_for(self, entry):
+        if self.bot.loudness and entry.filename:
+            return self.bot.loudness.gain_for(entry.filename)
+
+        return 1.0
+
+    def _start_player(self, entry, *, packets=None, process=None, start_frame=0):
+        """
+            Starts playing `entry`, `start_frame` 20ms frames in.  Sends `packets` as they are if given,
+            otherwise runs the song through ffmpeg.
+        """
+
+        # Threadsafe call soon, b/c after will be called from the voice playback thread.
+        after = lambda: self.loop.call_soon_threadsafe(self._playback_finished)
+
+        # Loudness normalization is just part of the volume multiply
+        self._gain = self._gain_for(entry)
+
+        if packets:
+            log.ffmpeg("Playing opus packets from {}".format(packets.filename))
+
+            self._current_player = OpusPacketPlayer(packets, self.voice_client, process=process, after=after)
+            self._stderr_future = asyncio.Future()
+            self._stderr_future.set_result(None)
+
+        else:
+            boptions = "-nostdin"
+            # aoptions = "-vn -b:a 192k"
+            aoptions = "-vn"
+
+            hints = _input_hints(self.bot.probes.get(entry.filename))
+            if hints:
+                boptions += " " + " ".join(hints)
+
+            if start_frame:
+                boptions += " -ss {:.2f}".format(start_frame * 0.02)
+
+            log.ffmpeg("Creating player with options: {} {} {}".format(boptions, aoptions, entry.filename))
+
+            self._current_player = self._monkeypatch_player(self.voice_client.create_ffmpeg_player(
+                entry.filename,
+                before_options=boptions,
+                options=aoptions,
+                stderr=subprocess.PIPE,
+                after=after
+            ))
+            self._current_player.buff.volume = self.volume * self._gain
+            self._stderr_future = asyncio.Future()
+
+            stderr_thread = Thread(
+                target=filter_stderr,
+                args=(self._current_player.process, self._stderr_future),
+                name="{} stderr reader".format(self._current_player.name)
+            )
+
+            stderr_thread.start()
+
+        self._current_player.setDaemon(True)
+        self._current_player.buff.frame_count = start_frame
+
+        if self.is_paused:
+            self._current_player.pause()
+
+        self._current_player.start()
 
     def _monkeypatch_player(self, player):
         original_buff = player.buff
@@ -339,6 +494,20 @@ class MusicPlayer(EventEmitter, Serializable):
             'entries': self.playlist
         })
 
+    def snapshot(self):
+        """
+            What `serialize` would write, already turned into dicts and lists, so only the json text is left to
+            make off the event loop.  The entries are read here, while nothing else can change them.
+        """
+        data = self.__json__()
+        current = data['data']['current_entry']
+        if current['entry'] is not None:
+            current['entry'] = current['entry'].__json__()
+
+        playlist = data['data']['entries'] = self.playlist.__json__()
+        playlist['data']['entries'] = [entry.__json__() for entry in self.playlist.entries]
+        return data
+
     @classmethod
     def _deserialize(cls, data, bot=None, voice_client=None, playlist=None):
         assert bot is not None, cls._bad('bot')
@@ -398,6 +567,52 @@ class MusicPlayer(EventEmitter, Serializable):
             #       192k AKA sampleRate * (bitDepth / 8) * channelCount
             #       Change frame_count to bytes_read in the PatchedBuff
 
+def _input_hints(probe):
+    """
+        ffmpeg input options for a file that's already been probed, so ffmpeg doesn't have to work out
+        the container again before it starts.
+    """
+
+    if not probe or not probe.get('format'):
+        return []
+
+    return ['-f', probe['format'], '-probesize', '32768', '-analyzeduration', '0']
+
+
+def open_opus_passthrough(filename, hints=()):
+    """
+        Starts ffmpeg remuxing the opus audio of `filename` into an ogg stream, without decoding it.
+        Returns (OggOpusReader, process), or (None, None) if the audio isn't opus in 20ms frames,
+        which is the only frame size discord's packet timestamps allow for.  Blocks until ffmpeg has
+        written the headers, so call it from an executor.
+    """
+
+    args = ['ffmpeg', '-nostdin', '-loglevel', 'error'] + list(hints) + ['-i', filename, '-map', '0:a:0', '-vn',
+            '-c:a', 'copy', '-f', 'ogg', 'pipe:1']
+
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        log.warning("Could not start ffmpeg for opus passthrough", exc_info=True)
+        return None, None
+
+    try:
+        packets = OggOpusReader(process.stdout, name=filename)
+
+        first = packets.peek_packet()
+        if first and packet_duration(first) == 20:
+            return packets, process
+
+        log.ffmpeg("Opus in {} doesn't use 20ms frames, not passing it through".format(filename))
+        packets.close()
+
+    except Exception as e:
+        log.ffmpeg("No opus passthrough for {}: {}".format(filename, e))
+
+    process.kill()
+    process.wait()
+    return None, None
+
 # TODO: I need to add a check for if the eventloop is closed
 
 def filter_stderr(popen:subprocess.Popen, future:asyncio.Future):
@@ -1,8 +1,8 @@
 import os.path
+import asyncio
 import logging
 import datetime
 
-from random import shuffle
 from itertools import islice
 from collections import deque
 
@@ -12,11 +12,16 @@ from youtube_dl.utils import ExtractorError, DownloadError, UnsupportedError
 from .utils import get_header
 from .constructs import Serializable
 from .lib.event_emitter import EventEmitter
+from .lib.indexed_queue import IndexedQueue, FairQueue
+from .downloader import PRIORITY_NEXT, PRIORITY_PREFETCH, PRIORITY_IDLE
 from .entry import URLPlaylistEntry, StreamPlaylistEntry
 from .exceptions import ExtractionError, WrongEntryTypeError
 
 log = logging.getLogger(__name__)
 
+# Rough size of a bestaudio download per second, for entries that aren't downloaded yet
+_estimated_bytes_per_second = 16000
+
 
 class Playlist(EventEmitter, Serializable):
     """
@@ -28,7 +33,16 @@ class Playlist(EventEmitter, Serializable):
         self.bot = bot
         self.loop = bot.loop
         self.downloader = bot.downloader
-        self.entries = deque()
+        queue_type = FairQueue if bot.config.fair_queue else IndexedQueue
+        self.entries = queue_type(weight=_entry_duration, group=_entry_author)
+
+        self._prefetched = set()
+        self.journal = None
+        self.loading_entry = None
+        self._skipped_entry = None
+        self.plays = 0
+        self.waits = 0
+        self.wait_time = 0.0
 
     def __iter__(self):
         return iter(self.entries)
@@ -37,11 +51,42 @@ class Playlist(EventEmitter, Serializable):
         return len(self.entries)
 
     def shuffle(self):
-        shuffle(self.entries)
+        self.entries.shuffle()
+
+        if self.journal is not None:
+            self.journal.invalidate()
+        self._prefetch()
 
     def clear(self):
+        # Nothing's going to play these, so their downloads would only hold up everyone else's
+        for entry in self.entries:
+            entry.cancel_download()
+
         self.entries.clear()
 
+        if self.journal is not None:
+            self.journal.clear()
+        self._prefetch()
+
+    def skip_loading(self):
+        """
+            Gives up on the entry `get_next_entry` is waiting to download, and cancels its download.
+            `get_next_entry` moves on to the entry after it.  Returns the skipped entry, or None.
+        """
+        entry = self.loading_entry
+        if entry and entry.cancel_download():
+            self._skipped_entry = entry
+            return entry
+
+    def prefetch_stats(self):
+        return {
+            'plays': self.plays,
+            'waits': self.waits,
+            'wait_ratio': self.waits / self.plays if self.plays else 0,
+            'wait_time': self.wait_time,
+            'prefetching': len(self._prefetched)
+        }
+
     async def add_entry(self, song_url, **meta):
         """
             Validates and adds a song_url to be played. This does not start the download of the song.
@@ -52,6 +97,35 @@ class Playlist(EventEmitter, Serializable):
             :param meta: Any additional metadata to add to the playlist entry.
         """
 
+        entry = await self._resolve_entry(song_url, **meta)
+        self._add_entry(entry)
+        return entry, self.position_of(entry)
+
+    async def predownload(self, song_url):
+        """
+            Downloads song_url at prefetch priority the same way a queued entry would, without queueing it.
+            The file ends up in the audio cache like any other, so it's found if the song gets queued and aged
+            out if it doesn't.  Cancelling this stops the download unless a queued entry is waiting on it too.
+        """
+
+        # Same lookups, in the same order, as queueing a song makes
+        await self.downloader.prefetch_info(self.loop, [song_url])[0]
+
+        entry = await self._resolve_entry(song_url)
+        if not isinstance(entry, URLPlaylistEntry):
+            return
+
+        try:
+            await entry.get_ready_future(PRIORITY_PREFETCH)
+        except asyncio.CancelledError:
+            entry.cancel_download()
+            raise
+
+    async def _resolve_entry(self, song_url, **meta):
+        """
+            Validates song_url and builds an entry for it, without adding it to the playlist.
+        """
+
         try:
             info = await self.downloader.extract_info(self.loop, song_url, download=False)
         except Exception as e:
@@ -65,7 +139,7 @@ class Playlist(EventEmitter, Serializable):
             raise WrongEntryTypeError("This is a playlist.", True, info.get('webpage_url', None) or info.get('url', None))
 
         if info.get('is_live', False):
-            return await self.add_stream_entry(song_url, info=info, **meta)
+            return await self._resolve_stream_entry(song_url, info=info, **meta)
 
         # TODO: Extract this to its own function
         if info['extractor'] in ['generic', 'Dropbox']:
@@ -86,12 +160,12 @@ class Playlist(EventEmitter, Serializable):
 
                 elif content_type.startswith('text/html'):
                     log.warning("Got text/html for content-type, this might be a stream. Attempting to stream.")
-                    return await self.add_stream_entry(song_url, info=info, **meta) # TODO: Check for shoutcast/icecast
+                    return await self._resolve_stream_entry(song_url, info=info, **meta) # TODO: Check for shoutcast/icecast
 
                 elif not content_type.startswith(('audio/', 'video/')):
                     log.warning("Questionable content-type \"{}\" for url {}".format(content_type, song_url))
 
-        entry = URLPlaylistEntry(
+        return URLPlaylistEntry(
             self,
             song_url,
             info.get('title', 'Untitled'),
@@ -99,10 +173,13 @@ class Playlist(EventEmitter, Serializable):
             self.downloader.ytdl.prepare_filename(info),
             **meta
         )
-        self._add_entry(entry)
-        return entry, len(self.entries)
 
     async def add_stream_entry(self, song_url, info=None, **meta):
+        entry = await self._resolve_stream_entry(song_url, info=info, **meta)
+        self._add_entry(entry)
+        return entry, self.position_of(entry)
+
+    async def _resolve_stream_entry(self, song_url, info=None, **meta):
         if info is None:
             info = {'title': song_url, 'extractor': None}
 
@@ -138,15 +215,13 @@ class Playlist(EventEmitter, Serializable):
 
         # TODO: A bit more validation, "~stream some_url" should not just say :ok_hand:
 
-        entry = StreamPlaylistEntry(
+        return StreamPlaylistEntry(
             self,
             song_url,
             title,
             destination = dest_url,
             **meta
         )
-        self._add_entry(entry)
-        return entry, len(self.entries)
 
     #Custom
     async def priority_import_from(self, playlist_url, **meta):
@@ -189,9 +264,7 @@ class Playlist(EventEmitter, Serializable):
                         **meta
                     )
 
-                    self._add_entry_custom(entry)
-                    #Fixed
-                    entry_list = [entry] + entry_list
+                    entry_list.append(entry)
                 except Exception as e:
                     baditems += 1
                     log.warning("Could not add item", exc_info=e)
@@ -202,15 +275,37 @@ class Playlist(EventEmitter, Serializable):
         if baditems:
             log.info("Skipped {} bad entries".format(baditems))
 
+        # All at once, so the whole playlist goes in front of the queue in its own order
+        self._add_entries_head(entry_list)
+
         return entry_list, 0
 
     def _add_entry_custom(self, entry, *, head=False):
         self.entries.appendleft(entry)
 
+        if self.journal is not None:
+            self.journal.insert(0, [entry], head=True)
+
         self.emit('entry-added', playlist=self, entry=entry)
 
-        if self.peek() is entry:
-            entry.get_ready_future()
+        self._prefetch()
+
+    def _add_entries_head(self, entries):
+        """
+            Puts `entries` in front of the queue, in order, with a single `entries-added` event.
+        """
+        if not entries:
+            return
+
+        self.entries.extendleft(entries)
+
+        if self.journal is not None:
+            self.journal.insert(0, entries, head=True)
+
+        self.emit('entries-added', playlist=self, entries=entries)
+
+        self._prefetch()
+
     async def add_entry_custom(self, song_url, **meta):
         """
             Validates and adds a song_url to be played. This does not start the download of the song.
@@ -271,58 +366,30 @@ class Playlist(EventEmitter, Serializable):
         self._add_entry_custom(entry)
         return entry, len(self.entries)
 
-    async def import_from(self, playlist_url, **meta):
+    async def stream_import_from(self, playlist_url, **meta):
         """
-            Imports the songs from `playlist_url` and queues them to be played.
+            Imports the songs from `playlist_url` without resolving the whole playlist up front.  The playlist is
+            flat-extracted and its songs are resolved and queued in order as they become ready, so the first song can
+            start playing while the rest are still being looked up.  Progress is reported with `import-progress`.
 
             Returns a list of `entries` that have been enqueued.
 
             :param playlist_url: The playlist url to be cut into individual urls and added to the playlist
             :param meta: Any additional metadata to add to the playlist entry
         """
-        position = len(self.entries) + 1
-        entry_list = []
 
         try:
-            info = await self.downloader.safe_extract_info(self.loop, playlist_url, download=False)
+            info = await self.downloader.safe_extract_info(self.loop, playlist_url, download=False, process=False)
         except Exception as e:
             raise ExtractionError('Could not extract information from {}\n\n{}'.format(playlist_url, e))
 
         if not info:
             raise ExtractionError('Could not extract information from %s' % playlist_url)
 
-        # Once again, the generic extractor fucks things up.
-        if info.get('extractor', None) == 'generic':
-            url_field = 'url'
-        else:
-            url_field = 'webpage_url'
-
-        baditems = 0
-        for item in info['entries']:
-            if item:
-                try:
-                    entry = URLPlaylistEntry(
-                        self,
-                        item[url_field],
-                        item.get('title', 'Untitled'),
-                        item.get('duration', 0) or 0,
-                        self.downloader.ytdl.prepare_filename(item),
-                        **meta
-                    )
-
-                    self._add_entry(entry)
-                    entry_list.append(entry)
-                except Exception as e:
-                    baditems += 1
-                    log.warning("Could not add item", exc_info=e)
-                    log.debug("Item: {}".format(item), exc_info=True)
-            else:
-                baditems += 1
-
-        if baditems:
-            log.info("Skipped {} bad entries".format(baditems))
+        song_urls = [_flat_entry_url(entry_data) for entry_data in info.get('entries') or ()]
+        del info
 
-        return entry_list, position
+        return await self._add_entries_ordered(song_urls, source=playlist_url, **meta)
 
     async def async_process_youtube_playlist(self, playlist_url, **meta):
         """
@@ -340,31 +407,10 @@ class Playlist(EventEmitter, Serializable):
         if not info:
             raise ExtractionError('Could not extract information from %s' % playlist_url)
 
-        gooditems = []
-        baditems = 0
-
-        for entry_data in info['entries']:
-            if entry_data:
-                baseurl = info['webpage_url'].split('playlist?list=')[0]
-                song_url = baseurl + 'watch?v=%s' % entry_data['id']
+        baseurl = info['webpage_url'].split('playlist?list=')[0]
+        song_urls = [baseurl + 'watch?v=%s' % entry_data['id'] if entry_data else None for entry_data in info['entries']]
 
-                try:
-                    entry, elen = await self.add_entry(song_url, **meta)
-                    gooditems.append(entry)
-
-                except ExtractionError:
-                    baditems += 1
-
-                except Exception as e:
-                    baditems += 1
-                    log.error("Error adding entry {}".format(entry_data['id']), exc_info=e)
-            else:
-                baditems += 1
-
-        if baditems:
-            log.info("Skipped {} bad entries".format(baditems))
-
-        return gooditems
+        return await self._add_entries_ordered(song_urls, source=playlist_url, **meta)
 
     async def async_process_sc_bc_playlist(self, playlist_url, **meta):
         """
@@ -382,25 +428,78 @@ class Playlist(EventEmitter, Serializable):
         if not info:
             raise ExtractionError('Could not extract information from %s' % playlist_url)
 
+        song_urls = [entry_data['url'] if entry_data else None for entry_data in info['entries']]
+
+        return await self._add_entries_ordered(song_urls, source=playlist_url, **meta)
+
+    async def _add_entries_ordered(self, song_urls, *, source=None, **meta):
+        """
+            Resolves `song_urls` with up to `bot.config.playlist_concurrency` lookups at a time, and adds them to the
+            playlist in their original order.  Each entry is added as soon as it and everything before it is resolved,
+            and only a small window of lookups past the oldest unresolved url is started at once.
+            Urls that are None or fail to resolve are skipped and logged.
+
+            Emits `import-progress` after every url with `source`, `done`, `total`, `added` and `failed`.
+
+            Returns the list of entries that were added.
+        """
+
+        concurrency = max(1, self.bot.config.playlist_concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resolve(song_url):
+            async with semaphore:
+                return await self._resolve_entry(song_url, **meta)
+
+        def start(song_url):
+            if not song_url:
+                return None
+            return asyncio.ensure_future(resolve(song_url), loop=self.loop)
+
+        total = len(song_urls)
+        pending = deque()
+        upcoming = iter(song_urls)
+
         gooditems = []
         baditems = 0
 
-        for entry_data in info['entries']:
-            if entry_data:
-                song_url = entry_data['url']
+        try:
+            for song_url in islice(upcoming, concurrency * 2):
+                pending.append((song_url, start(song_url)))
 
-                try:
-                    entry, elen = await self.add_entry(song_url, **meta)
-                    gooditems.append(entry)
+            for position in range(1, total + 1):
+                song_url, task = pending.popleft()
 
-                except ExtractionError:
-                    baditems += 1
+                for next_url in islice(upcoming, 1):
+                    pending.append((next_url, start(next_url)))
 
-                except Exception as e:
+                if task is None:
                     baditems += 1
-                    log.error("Error adding entry {}".format(entry_data['id']), exc_info=e)
-            else:
-                baditems += 1
+
+                else:
+                    try:
+                        entry = await task
+
+                    except ExtractionError as e:
+                        baditems += 1
+                        log.warning("Skipping playlist item {} ({}): {}".format(position, song_url, e))
+
+                    except Exception as e:
+                        baditems += 1
+                        log.error("Error adding playlist item {} ({})".format(position, song_url), exc_info=e)
+
+                    else:
+                        self._add_entry(entry)
+                        gooditems.append(entry)
+
+                self.emit('import-progress', playlist=self, source=source,
+                          done=position, total=total, added=len(gooditems), failed=baditems)
+
+        finally:
+            # If we were cancelled partway through, don't leave lookups running for entries nobody will add
+            for _, task in pending:
+                if task and not task.done():
+                    task.cancel()
 
         if baditems:
             log.info("Skipped {} bad entries".format(baditems))
@@ -413,29 +512,102 @@ class Playlist(EventEmitter, Serializable):
         else:
             self.entries.append(entry)
 
+        if self.journal is not None:
+            self.journal.insert(self.entries.index(entry), [entry], head=head)
+
         self.emit('entry-added', playlist=self, entry=entry)
 
-        if self.peek() is entry:
-            entry.get_ready_future()
+        self._prefetch()
 
     async def get_next_entry(self, predownload_next=True):
         """
             A coroutine which will return the next song or None if no songs left to play.
 
             Additionally, if predownload_next is set to True, it will attempt to download the next
-            song to be played - so that it's ready by the time we get to it.
+            songs to be played (see `_prefetch`) - so that they're ready by the time we get to them.
         """
         if not self.entries:
             return None
 
         entry = self.entries.popleft()
+        self._prefetched.discard(entry)
+
+        if self.journal is not None:
+            self.journal.remove(0)
 
         if predownload_next:
-            next_entry = self.peek()
-            if next_entry:
-                next_entry.get_ready_future()
+            self._prefetch()
+
+        self.plays += 1
+        if entry.is_downloaded:
+            return await entry.get_ready_future(PRIORITY_NEXT)
+
+        # The prefetch didn't get there in time, playback is going to stall on this
+        self.waits += 1
+        self.loading_entry = entry
+        started = self.loop.time()
+        try:
+            return await entry.get_ready_future(PRIORITY_NEXT)
+
+        except asyncio.CancelledError:
+            if self._skipped_entry is not entry:
+                raise
 
-        return await entry.get_ready_future()
+            self._skipped_entry = None
+
+        finally:
+            self.loading_entry = None
+            waited = self.loop.time() - started
+            self.wait_time += waited
+            log.debug("Waited {:.2f}s for {} to download ({}/{} plays waited)".format(
+                waited, entry.title, self.waits, self.plays))
+
+        log.info("Skipped {} while it was downloading".format(entry.title))
+        return await self.get_next_entry(predownload_next)
+
+    def _prefetch(self):
+        """
+            Readies the entries at the front of the queue in the background: up to `PrefetchDepth` of them,
+            stopping early once `PrefetchMaxSize` megabytes or `PrefetchMaxDuration` seconds are lined up.
+            The first entry is always readied.  It's bumped to the front of the downloader's queue once the
+            player actually waits on it.
+
+            Called whenever the front of the queue may have changed.  Downloads of entries that dropped
+            out of the window are moved to the back of the downloader's queue.
+        """
+        config = self.bot.config
+        max_bytes = config.prefetch_max_size * 1024 * 1024
+        max_duration = config.prefetch_max_duration
+
+        window = []
+        total_bytes = total_duration = 0
+
+        for entry in islice(self.entries, max(1, config.prefetch_depth)):
+            if window and ((max_bytes and total_bytes >= max_bytes) or
+                           (max_duration and total_duration >= max_duration)):
+                break
+
+            window.append(entry)
+            total_bytes += self._estimated_bytes(entry)
+            total_duration += entry.duration or 0
+
+        for entry in window:
+            # Entries coming back into the window get their priority back from get_ready_future
+            if entry not in self._prefetched and not entry.is_downloaded:
+                entry.get_ready_future(PRIORITY_PREFETCH)
+
+        for entry in self._prefetched.difference(window):
+            entry.set_download_priority(PRIORITY_IDLE)
+
+        self._prefetched = set(window)
+
+    def _estimated_bytes(self, entry):
+        if entry.filename:
+            size = self.downloader.cache_index.size_of(entry.filename)
+            if size is not None:
+                return size
+
+        return (entry.duration or 0) * _estimated_bytes_per_second
 
     def peek(self):
         """
@@ -448,7 +620,7 @@ class Playlist(EventEmitter, Serializable):
         """
             (very) Roughly estimates the time till the queue will 'position'
         """
-        estimated_time = sum(e.duration for e in islice(self.entries, position - 1))
+        estimated_time = self.entries.weight_before(position - 1)
 
         # When the player plays a song, it eats the first playlist item, so we just have to add the time back
         if not player.is_stopped and player.current_entry:
@@ -457,12 +629,38 @@ class Playlist(EventEmitter, Serializable):
         return datetime.timedelta(seconds=estimated_time)
 
     def count_for_user(self, user):
-        return sum(1 for e in self.entries if e.meta.get('author', None) == user)
+        return self.entries.count(user)
+
+    def position_of(self, entry):
+        """
+            Returns where `entry` is in the queue, counting from 1, or None if it isn't queued.
+        """
+        if entry in self.entries:
+            return self.entries.index(entry) + 1
 
+    def entry_id(self, entry):
+        """
+            Returns an id for a queued `entry` that stays the same while it's queued, or None.
+        """
+        return self.entries.id_of(entry)
+
+    def get_entry(self, entry_id):
+        """
+            Returns the queued entry with the id `entry_id`, or None.
+        """
+        return self.entries.get(entry_id)
+
+    def duration_changed(self, entry):
+        """
+            Called when `entry` finds out how long it is after being queued, to keep the queue times right.
+        """
+        self.entries.update(entry)
 
     def __json__(self):
         return self._enclose_json({
-            'entries': list(self.entries)
+            'entries': list(self.entries),
+            # Entries put in front of the queue skip the fair queue's rotation, appending them again wouldn't
+            'front': self.entries.front_length()
         })
 
     @classmethod
@@ -471,9 +669,42 @@ class Playlist(EventEmitter, Serializable):
         # log.debug("Deserializing playlist")
         pl = cls(bot)
 
-        for entry in raw_json['entries']:
-            pl.entries.append(entry)
+        front = raw_json.get('front', 0)
+
+        # Entries that couldn't be loaded come back as None
+        pl.entries.extendleft(entry for entry in raw_json['entries'][:front] if entry is not None)
+
+        for entry in raw_json['entries'][front:]:
+            if entry is not None:
+                pl.entries.append(entry)
 
         # TODO: create a function to init downloading (since we don't do it here)?
         return pl
 
+
+def _entry_duration(entry):
+    return entry.duration or 0
+
+
+def _entry_author(entry):
+    return entry.meta.get('author', None)
+
+
+def _flat_entry_url(entry_data):
+    """
+        Returns a url that can be extracted on its own for an entry of a flat-extracted (`process=False`) playlist.
+    """
+
+    if not entry_data:
+        return None
+
+    if entry_data.get('webpage_url'):
+        return entry_data['webpage_url']
+
+    url = entry_data.get('url')
+
+    # Flat youtube playlists only give us the video id
+    if url and entry_data.get('ie_key') == 'Youtube' and '/' not in url:
+        return 'https://www.youtube.com/watch?v=%s' % url
+
+    return url